@@ -0,0 +1,117 @@
+import sys
+import tracemalloc
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from buildcleaner.node import FileNode
+from buildcleaner.node import LabelRegistry
+from buildcleaner.node import Node
+from buildcleaner.node import TargetNode
+from buildcleaner.rule import BuiltInRules
+from buildcleaner.rule import Rule
+
+
+# Memory taken by the nodes of a synthetic graph, shaped like a typical
+# tensorflow one: several source files and a generated file per rule target.
+# The graph is measured as built, with attributes allocated on first access,
+# and with the attributes of every node allocated, as if it was done eagerly.
+# The baseline is the eager graph with the same attributes kept in instance
+# dicts, as they were before nodes had __slots__.
+#   python benchmarks/node_memory.py [<rule targets count>]
+
+
+# Node without __slots__, holds the attributes of a node in its __dict__
+class _DictNode:
+  _SLOTS: List[str] = [*Node.__slots__, *TargetNode.__slots__]
+
+  def __init__(self, node: TargetNode) -> None:
+    for slot in _DictNode._SLOTS:
+      setattr(self, slot, getattr(node, slot))
+
+
+def _build_graph(registry: LabelRegistry, targets_count: int) -> List[
+  TargetNode]:
+  cc_library: Rule = BuiltInRules.rules()["cc_library"]
+  nodes: List[TargetNode] = []
+  for i in range(targets_count):
+    pkg: str = f"//tensorflow/core/p{i // 10}"
+    target: TargetNode = registry.reference(f"{pkg}:t{i}")
+    registry.define_target(cc_library, target.label)
+    target.label_list_args["srcs"] = [registry.reference(f"{pkg}:t{i}_{j}.cc")
+                                      for j in range(3)]
+    target.label_list_args["hdrs"] = [registry.reference(f"{pkg}:t{i}.h")]
+    target.label_list_args["deps"] = [
+        registry.reference(f"{pkg}:t{(i + j) % targets_count}") for j in
+        range(1, 4)]
+    target.string_list_args["copts"] = ["-DX=1"]
+    gen_file: TargetNode = registry.reference(f"{pkg}:t{i}.pb.h")
+    registry.define_generated_file(gen_file.label, target)
+    nodes.append(target)
+    nodes.append(gen_file)
+  for placeholder in registry.placeholders():
+    source_file: Optional[FileNode] = registry.define_source_file(
+        placeholder.label)
+    if source_file is not None:
+      nodes.append(source_file)
+  return nodes
+
+
+def _allocate_attributes(nodes: List[TargetNode]) -> List[TargetNode]:
+  for node in nodes:
+    # Each of the properties allocates its attribute on the first access
+    _ = (node.label_list_args, node.label_args, node.string_list_args,
+         node.string_args, node.bool_args, node.int_args,
+         node.str_str_map_args, node.out_label_list_args, node.out_label_args,
+         node.outputs)
+  return nodes
+
+
+def _traced(build: Callable[[], Any]) -> Tuple[Any, int]:
+  tracemalloc.start()
+  start: int = tracemalloc.get_traced_memory()[0]
+  built: Any = build()
+  size: int = tracemalloc.get_traced_memory()[0] - start
+  tracemalloc.stop()
+  return built, size
+
+
+def _report(name: str, nodes_count: int, size: int) -> None:
+  print(f"    {name}: {nodes_count} nodes, {size / nodes_count:.0f} bytes per "
+        f"node ({size / 1024 / 1024:.1f} MiB total)")
+
+
+def _measure(name: str, build: Callable[[], List[TargetNode]]) -> Tuple[
+  List[TargetNode], int]:
+  nodes: List[TargetNode]
+  size: int
+  nodes, size = _traced(build)
+  _report(name, len(nodes), size)
+  return nodes, size
+
+
+# Size of the eager graph with the slotted nodes replaced by dict ones
+def _measure_without_slots(nodes: List[TargetNode], eager_size: int) -> int:
+  dict_nodes_size: int = _traced(lambda: [_DictNode(n) for n in nodes])[1]
+  size: int = eager_size - sum(sys.getsizeof(n) for n in nodes) + \
+              dict_nodes_size
+  _report("Eager attributes without __slots__", len(nodes), size)
+  return size
+
+
+if __name__ == '__main__':
+  targets: int = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  eager_nodes: List[TargetNode]
+  eager_size: int
+  eager_nodes, eager_size = _measure(
+      "Eager attributes",
+      lambda: _allocate_attributes(_build_graph(LabelRegistry(), targets)))
+  dict_size: int = _measure_without_slots(eager_nodes, eager_size)
+  del eager_nodes
+  lazy_size: int = _measure("Lazy attributes",
+                            lambda: _build_graph(LabelRegistry(), targets))[1]
+  print(f"    __slots__ save {1 - eager_size / dict_size:.0%}, lazy attributes "
+        f"another {1 - lazy_size / eager_size:.0%} "
+        f"({1 - lazy_size / dict_size:.0%} of the baseline)")
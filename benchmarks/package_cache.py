@@ -0,0 +1,93 @@
+import gc
+import os
+import sys
+import tempfile
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from buildcleaner.cache import PackageParseCache
+from buildcleaner.cache import QueryCache
+from buildcleaner.node import LabelRegistry
+from buildcleaner.parser import BazelBuildTargetsParser
+from buildcleaner.rule import BuiltInRules
+from buildcleaner.rule import Rule
+
+
+# Time to parse build output of a synthetic workspace without the package
+# parse cache, with a cold one (which is filled on the way) and with a warm
+# one, as on the next run over an unchanged workspace.
+#   python benchmarks/package_cache.py [<packages count> [<targets count>]]
+
+
+def _create_workspace(workspace_path: str, packages_count: int,
+    targets_count: int) -> List[str]:
+  os.makedirs(os.path.join(workspace_path, "tools"))
+  with open(os.path.join(workspace_path, "tools", "BUILD"), "w"):
+    pass
+  with open(os.path.join(workspace_path, "tools", "defs.bzl"), "w") as f:
+    f.write("def tf_cc_library(**kwargs):\n  native.cc_library(**kwargs)\n")
+
+  blocks: List[str] = []
+  for p in range(packages_count):
+    package: str = f"tensorflow/core/p{p // 10}/s{p % 10}"
+    package_path: str = os.path.join(workspace_path, package)
+    os.makedirs(package_path)
+    with open(os.path.join(package_path, "BUILD"), "w") as f:
+      f.write('load("//tools:defs.bzl", "tf_cc_library")\n\n'
+              'tf_cc_library(name = "t", srcs = glob(["*.cc"]))\n')
+    for t in range(targets_count):
+      with open(os.path.join(package_path, f"t{t}.cc"), "w"):
+        pass
+      srcs: str = ", ".join(
+          f'"//{package}:t{t}_{j}.cc"' for j in range(4))
+      deps: str = ", ".join(
+          f'"//tensorflow/core/p{(p + j) // 10 % (packages_count // 10 or 1)}'
+          f'/s{(p + j) % 10}:t{t}"' for j in range(1, 4))
+      blocks.append("\n".join([
+          f"# {package_path}/BUILD:{t + 3}:14",
+          "cc_library(",
+          f'  name = "t{t}",',
+          '  generator_name = "t",',
+          '  generator_function = "tf_cc_library",',
+          f'  generator_location = "{package}/BUILD:{t + 3}:14",',
+          f"  srcs = [{srcs}],",
+          f'  hdrs = ["//{package}:t{t}.h"],',
+          f"  deps = [{deps}],",
+          '  copts = ["-DEIGEN_AVOID_STL_ARRAY", "-Wno-sign-compare"],',
+          '  linkopts = ["-lm"],',
+          '  features = ["-parse_headers"],',
+          "  alwayslink = True,",
+          '  visibility = ["//visibility:public"],',
+          ")",
+          f"# Rule t{t} instantiated at (most recent call last):",
+          f"#   {package_path}/BUILD:{t + 3}:14 in <toplevel>"]))
+  return blocks
+
+
+def _measure(name: str, workspace_path: str, blocks: List[str],
+    query_cache: Optional[QueryCache]) -> None:
+  rules: Dict[str, Rule] = BuiltInRules.rules()
+  package_cache: Optional[PackageParseCache] = PackageParseCache(
+      query_cache, workspace_path, rules.values()) if query_cache else None
+  parser: BazelBuildTargetsParser = BazelBuildTargetsParser(
+      workspace_path, rules, {}, LabelRegistry(), package_cache=package_cache)
+  # Garbage of the previous measurements would slow down the collections
+  gc.collect()
+  start: float = time.perf_counter()
+  parser.parse_query_build_blocks(blocks)
+  print(f"    {name}: {len(blocks)} blocks, "
+        f"{time.perf_counter() - start:.3f}s")
+
+
+if __name__ == '__main__':
+  packages: int = int(sys.argv[1]) if len(sys.argv) > 1 else 2760
+  targets: int = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+  with tempfile.TemporaryDirectory() as temp_path:
+    workspace: str = os.path.join(temp_path, "workspace")
+    build_blocks: List[str] = _create_workspace(workspace, packages, targets)
+    cache: QueryCache = QueryCache(os.path.join(temp_path, "cache"))
+    _measure("No cache", workspace, build_blocks, None)
+    _measure("Cold cache", workspace, build_blocks, cache)
+    _measure("Warm cache", workspace, build_blocks, cache)
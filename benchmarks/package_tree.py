@@ -0,0 +1,37 @@
+import random
+import sys
+import time
+from typing import List
+
+from buildcleaner.graph import PackageTree
+from buildcleaner.node import FileNode
+from buildcleaner.node import TargetNode
+
+
+# Time to build the package tree of a synthetic graph, with the nodes in
+# random order and sorted by label.
+#   python benchmarks/package_tree.py [<nodes count>]
+
+
+def _create_nodes(nodes_count: int) -> List[TargetNode]:
+  nodes: List[TargetNode] = []
+  for i in range(nodes_count):
+    package: str = f"//tensorflow/core/p{i // 500}/s{i // 50 % 10}"
+    nodes.append(FileNode(f"f{i}.cc", package))
+  return nodes
+
+
+def _measure(order: str, nodes: List[TargetNode]) -> None:
+  start: float = time.perf_counter()
+  PackageTree().build_package_tree(nodes)
+  print(f"    {order}: {len(nodes)} nodes, "
+        f"{time.perf_counter() - start:.3f}s")
+
+
+if __name__ == '__main__':
+  count: int = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  target_nodes: List[TargetNode] = _create_nodes(count)
+  random.Random(0).shuffle(target_nodes)
+  _measure("Random order", target_nodes)
+  target_nodes.sort(key=lambda n: n.label)
+  _measure("Sorted order", target_nodes)
@@ -1,10 +1,27 @@
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from queue import Queue
+from typing import Any
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import cast
 
 from buildcleaner.config import BaseTargetsConfig
 from buildcleaner.graph import PackageTree
 from buildcleaner.graph import TargetDag
+from buildcleaner.node import FileNode
+from buildcleaner.node import LabelRegistry
 from buildcleaner.node import RepositoryNode
 from buildcleaner.node import RootNode
 from buildcleaner.node import TargetNode
@@ -14,10 +31,19 @@ from buildcleaner.runner import BazelRunner
 
 class Build:
   def __init__(self, base_targets: BaseTargetsConfig,
-      parser: BazelBuildTargetsParser):
-    bazel_runner: BazelRunner = BazelRunner()
-    targets_collector: TargetsCollector = TargetsCollector(bazel_runner,
-                                                           parser)
+      parser: BazelBuildTargetsParser, bazel_runner: BazelRunner):
+    targets_collector: TargetsCollector
+    if base_targets.jobs > 1:
+      targets_collector = ChunkedTargetsCollector(
+          bazel_runner, parser, base_targets.jobs,
+          base_targets.output_base_root, base_targets.min_chunk_size,
+          base_targets.query_output, base_targets.infer_label_kinds,
+          base_targets.query_command, base_targets.parse_jobs)
+    else:
+      targets_collector = TargetsCollector(
+          bazel_runner, parser, base_targets.secondary_output_base,
+          base_targets.query_output, base_targets.infer_label_kinds,
+          base_targets.query_command, base_targets.parse_jobs)
     all_target_nodes: Dict[
       str, TargetNode] = targets_collector.collect_dependencies(
         [base_targets.target], base_targets.bazel_config,
@@ -36,12 +62,55 @@ class Build:
 
 class TargetsCollector:
   def __init__(self, runner: BazelRunner,
-      bazel_query_parser: BazelBuildTargetsParser) -> None:
+      bazel_query_parser: BazelBuildTargetsParser,
+      secondary_output_base: str = "", query_output: str = "build",
+      infer_label_kinds: bool = False, query_command: str = "cquery",
+      parse_jobs: int = 1) -> None:
+    if query_output not in ("build", "streamed_proto", "jsonproto"):
+      raise ValueError(f"Unsupported query output: {query_output}")
+    if query_command not in ("cquery", "query"):
+      raise ValueError(f"Unsupported query command: {query_command}")
+    if query_command == "query" and query_output != "build":
+      # Only build output shows select() in a way it can be detected
+      raise ValueError(
+          f"Query command supports only build output: {query_output}")
     self._runner: BazelRunner = runner
     self._bazel_query_parser: BazelBuildTargetsParser = bazel_query_parser
+    self._label_registry: LabelRegistry = \
+      bazel_query_parser.get_label_registry()
+    self._secondary_output_base: str = secondary_output_base
+    self._query_output: str = query_output
+    self._infer_label_kinds: bool = infer_label_kinds
+    self._query_command: str = query_command
+    self._parse_jobs: int = parse_jobs
+    # Process pool for decoding build output, exists only while dependencies
+    # are being collected
+    self._parse_pool: Optional[ProcessPoolExecutor] = None
+    self._round_stats: RoundStats = RoundStats()
 
   def collect_dependencies(self, targets: List[str],
       bazel_config: str, excluded_targets: List[str]) -> Dict[str, TargetNode]:
+    if self._parse_jobs <= 1 or self._query_output != "build":
+      return self._collect_dependencies(targets, bazel_config,
+                                        excluded_targets)
+    # Workers must not be forked from this process: queries run in threads,
+    # and a fork taken while one of them holds a lock would deadlock. Fork
+    # server (or spawn where there is none) starts them from a clean process.
+    start_method: str = "forkserver"
+    if start_method not in multiprocessing.get_all_start_methods():
+      start_method = "spawn"
+    with ProcessPoolExecutor(
+        max_workers=self._parse_jobs,
+        mp_context=multiprocessing.get_context(start_method)) as parse_pool:
+      self._parse_pool = parse_pool
+      try:
+        return self._collect_dependencies(targets, bazel_config,
+                                          excluded_targets)
+      finally:
+        self._parse_pool = None
+
+  def _collect_dependencies(self, targets: List[str],
+      bazel_config: str, excluded_targets: List[str]) -> Dict[str, TargetNode]:
 
     all_nodes: Dict[str, TargetNode] = {}
     unresolved_labels = list(targets)
@@ -49,28 +118,31 @@ class TargetsCollector:
     excluded_prefixes: List[str] = self._calculate_excluded_target_prefixes(
         excluded_targets)
 
+    # Rule targets present in query output, but not parsed into nodes
+    skipped_labels: Set[str] = set()
+
     runs: int = 0
     while unresolved_labels:
       runs += 1
+      self._round_stats = RoundStats()
+      # Everything collected on previous rounds is subtracted from the query,
+      # so each round downloads and parses only the new part of the graph.
+      known_labels: Set[str] = set(all_nodes) | skipped_labels
       internal_nodes: Dict[str, TargetNode]
-      query_output: str = self._runner.query_deps_output(unresolved_labels,
-                                                         bazel_config,
-                                                         "build",
-                                                         actual_excluded_targets)
-      internal_nodes, _, _ = self._bazel_query_parser.parse_query_build_output(
-          query_output)
+      source_labels: Set[str]
+      internal_nodes, source_labels = self._query_deps(
+          unresolved_labels, bazel_config,
+          actual_excluded_targets + sorted(known_labels), skipped_labels,
+          known_labels)
+      nodes_count: int = len(all_nodes)
       all_nodes.update(internal_nodes)
-
-      # Resolve references
-      query_output = self._runner.query_deps_output(unresolved_labels,
-                                                    bazel_config,
-                                                    "label_kind",
-                                                    actual_excluded_targets)
-      nodes_by_kind: Dict[str, Dict[
-        str, TargetNode]] = self._bazel_query_parser.parse_query_label_kind_output(
-          query_output)
-      all_nodes.update(
-          self.resolve_label_references(all_nodes, nodes_by_kind["source"]))
+      # References are resolved by the label registry as the rules are parsed,
+      # only the referenced source files are left to define.
+      if self._infer_label_kinds:
+        all_nodes.update(
+            self._infer_source_files(excluded_prefixes, skipped_labels))
+      else:
+        all_nodes.update(self._define_source_files(source_labels))
 
       # The only allowed unresolved references are the ones which were excluded by
       # excluded_targets.
@@ -79,6 +151,13 @@ class TargetsCollector:
         TargetNode, List[str]] = tree.get_unresolved_targets(all_nodes.values(),
                                                              excluded_prefixes)
 
+      self._round_stats.new_nodes = len(all_nodes) - nodes_count
+      print(f"    Round {runs}: {len(unresolved_labels)} targets, "
+            f"{self._round_stats.new_nodes} new nodes, "
+            f"{self._round_stats.reused_nodes} reused nodes "
+            f"({self._round_stats.reuse_ratio():.0%}), "
+            f"query {self._round_stats.query_time:.1f}s, "
+            f"parse {self._round_stats.parse_time:.1f}s")
       unresolved_labels = [str(k) for k, _ in unresolved_targets.items()]
 
       # The excluded targets matter only on the first run, on the subsequent run
@@ -91,8 +170,147 @@ class TargetsCollector:
     # visited: Dict[TargetNode, Set[TargetNode]] = {}
     # dag.dfs_graph()
 
+    unknown_rule_kinds: List[
+      Tuple[str, int]] = self._bazel_query_parser.get_unknown_rule_kinds()
+    if unknown_rule_kinds:
+      unknown_rule_kinds_str: str = ", ".join(
+          [f"{kind} ({count})" for kind, count in unknown_rule_kinds])
+      print(f"    Unknown rule kinds: {unknown_rule_kinds_str}")
+    rejected_targets: List[
+      Tuple[str, int]] = self._bazel_query_parser.get_rejected_targets()
+    if rejected_targets:
+      rejected_targets_str: str = ", ".join(
+          [f"{reason} ({count})" for reason, count in rejected_targets])
+      print(f"    Rejected targets: {rejected_targets_str}")
+
     return all_nodes
 
+  def _query_deps(self, targets: List[str], bazel_config: str,
+      excluded_targets: List[str], skipped_labels: Set[str],
+      known_labels: Set[str]) -> Tuple[Dict[str, TargetNode], Set[str]]:
+    if self._infer_label_kinds:
+      # Source files are inferred from build output later, no need in
+      # label_kind query
+      return self._query_build(targets, bazel_config, excluded_targets, "",
+                               skipped_labels, known_labels), set()
+
+    if not self._secondary_output_base:
+      return (self._query_build(targets, bazel_config, excluded_targets, "",
+                                skipped_labels, known_labels),
+              self._query_source_files(targets, bazel_config, excluded_targets,
+                                       ""))
+
+    # Each query is parsed by the thread which ran it, so the output of the
+    # query which finishes first is parsed while the other one is still running
+    with ThreadPoolExecutor(max_workers=2) as executor:
+      build_future: Future = executor.submit(self._query_build, targets,
+                                             bazel_config, excluded_targets, "",
+                                             skipped_labels, known_labels)
+      source_files_future: Future = executor.submit(
+          self._query_source_files, targets, bazel_config, excluded_targets,
+          self._secondary_output_base)
+      return build_future.result(), source_files_future.result()
+
+  def _query_build(self, targets: List[str], bazel_config: str,
+      excluded_targets: List[str], output_base: str,
+      skipped_labels: Optional[Set[str]] = None,
+      known_labels: Optional[Set[str]] = None) -> Dict[str, TargetNode]:
+    start: float = time.monotonic()
+    query_time: float
+    reused_labels: Set[str] = set()
+    internal_nodes: Dict[str, TargetNode]
+    if self._query_output == "streamed_proto":
+      query_messages: _TimedIterable = _TimedIterable(
+          self._runner.stream_deps_messages(targets, bazel_config,
+                                            "streamed_proto", excluded_targets,
+                                            output_base))
+      internal_nodes, _, _ = self._bazel_query_parser.parse_query_proto_messages(
+          query_messages, skipped_labels, known_labels, reused_labels)
+      query_time = query_messages.elapsed
+    elif self._query_output == "jsonproto":
+      query_output: str = self._runner.query_deps_output(targets, bazel_config,
+                                                         "jsonproto",
+                                                         excluded_targets,
+                                                         output_base)
+      query_time = time.monotonic() - start
+      internal_nodes, _, _ = self._bazel_query_parser.parse_query_jsonproto_output(
+          query_output, skipped_labels, known_labels, reused_labels)
+    else:
+      ambiguous_labels: Optional[Set[str]] = (
+          set() if self._query_command == "query" else None)
+      query_blocks: _TimedIterable = _TimedIterable(
+          self._runner.stream_deps_output(targets, bazel_config, "build",
+                                          excluded_targets, output_base,
+                                          self._query_command))
+      internal_nodes, _, _ = self._bazel_query_parser.parse_query_build_blocks(
+          query_blocks, skipped_labels, known_labels, reused_labels,
+          ambiguous_labels, self._parse_pool)
+      query_time = query_blocks.elapsed
+      if ambiguous_labels:
+        internal_nodes.update(
+            self._query_configured_rules(sorted(ambiguous_labels), bazel_config,
+                                         output_base, skipped_labels))
+    self._round_stats.add(len(internal_nodes), len(reused_labels), query_time,
+                          time.monotonic() - start - query_time)
+    return internal_nodes
+
+  # Falls back to cquery for the rules whose attributes are ambiguous in bazel
+  # query output. The rules themselves are enough, as query closure is a
+  # superset of their configured dependencies.
+  def _query_configured_rules(self, targets: List[str], bazel_config: str,
+      output_base: str, skipped_labels: Optional[Set[str]]) -> Dict[
+    str, TargetNode]:
+    query_blocks: Iterable[str] = self._runner.stream_deps_output(
+        targets, bazel_config, "build", (), output_base, "cquery", 0)
+    internal_nodes: Dict[str, TargetNode]
+    internal_nodes, _, _ = self._bazel_query_parser.parse_query_build_blocks(
+        query_blocks, skipped_labels)
+    return internal_nodes
+
+  def _query_source_files(self, targets: List[str], bazel_config: str,
+      excluded_targets: List[str], output_base: str) -> Set[str]:
+    start: float = time.monotonic()
+    query_lines: _TimedIterable = _TimedIterable(
+        self._runner.stream_deps_lines(targets, bazel_config, "label_kind",
+                                       excluded_targets, output_base,
+                                       self._query_command))
+    source_labels: Set[str] = \
+      self._bazel_query_parser.parse_query_label_kind_lines(query_lines)
+    self._round_stats.add(0, 0, query_lines.elapsed,
+                          time.monotonic() - start - query_lines.elapsed)
+    return source_labels
+
+  # Every rule target in deps() closure is present in build output, so any
+  # still unresolved internal reference which is not a rule must be a source
+  # file, unless it is an output of a skipped rule (e.g. an ignored one).
+  # References to excluded packages stay unresolved, as they were filtered out
+  # of the query.
+  def _infer_source_files(self, excluded_prefixes: List[str],
+      skipped_labels: Set[str]) -> Dict[str, TargetNode]:
+    files_dict: Dict[str, TargetNode] = {}
+    for ref in self._label_registry.placeholders():
+      ref_str: str = str(ref)
+      if ref.is_external() or ref_str in skipped_labels:
+        continue
+      if TargetDag.node_belongs_to_excluded_package(ref, excluded_prefixes):
+        continue
+      file_node: Optional[FileNode] = self._label_registry.define_source_file(
+          ref_str)
+      if file_node:
+        files_dict[ref_str] = file_node
+    return files_dict
+
+  # Source files of label_kind output, which are referenced by the rules
+  def _define_source_files(self, source_labels: Set[str]) -> Dict[
+    str, TargetNode]:
+    files_dict: Dict[str, TargetNode] = {}
+    for label in source_labels:
+      file_node: Optional[FileNode] = self._label_registry.define_source_file(
+          label)
+      if file_node:
+        files_dict[label] = file_node
+    return files_dict
+
   def _calculate_excluded_target_prefixes(self, excluded_targets: List[str]) -> \
       List[str]:
     package_prefixes: List[str] = []
@@ -101,38 +319,138 @@ class TargetsCollector:
 
     return package_prefixes
 
-  def resolve_label_references(self, nodes_dict: Dict[str, TargetNode],
-      files_dict: Dict[str, TargetNode]) -> Dict[str, TargetNode]:
-    new_nodes: Dict[str, TargetNode] = {}
-    for label, generic_node in nodes_dict.items():
-      if not isinstance(generic_node, TargetNode):
-        continue
-      target_node: TargetNode = cast(TargetNode, generic_node)
-      ref_str: str
-      resolved_ref: TargetNode
-
-      for label_list_arg_name in target_node.label_list_args:
-        refs: List[TargetNode] = target_node.label_list_args[
-          label_list_arg_name]
-        target_node.label_list_args[label_list_arg_name] = []
-        for ref in refs:
-          resolved_ref = ref
-          ref_str = str(ref)
-          if ref_str in nodes_dict:
-            resolved_ref = nodes_dict[ref_str]
-          elif ref_str in files_dict:
-            resolved_ref = files_dict[ref_str]
-            new_nodes[ref_str] = resolved_ref
-          target_node.label_list_args[label_list_arg_name].append(resolved_ref)
-
-      for label_arg_name in target_node.label_args:
-        resolved_ref = target_node.label_args[label_arg_name]
-        ref_str = str(resolved_ref)
-        if ref_str in nodes_dict:
-          resolved_ref = nodes_dict[ref_str]
-        elif ref_str in files_dict:
-          resolved_ref = files_dict[ref_str]
-          new_nodes[ref_str] = resolved_ref
-        target_node.label_args[label_arg_name] = resolved_ref
-
-    return new_nodes
+
+# Statistics of a single collect_dependencies round. Queries of a round may run
+# concurrently, so the query and parse times are totals over all the queries.
+class RoundStats:
+  def __init__(self) -> None:
+    self.new_nodes: int = 0
+    # Rule nodes parsed from the query outputs and the ones reused instead
+    self.parsed_nodes: int = 0
+    self.reused_nodes: int = 0
+    self.query_time: float = 0.0
+    self.parse_time: float = 0.0
+    self._lock: threading.Lock = threading.Lock()
+
+  def add(self, parsed_nodes: int, reused_nodes: int, query_time: float,
+      parse_time: float) -> None:
+    with self._lock:
+      self.parsed_nodes += parsed_nodes
+      self.reused_nodes += reused_nodes
+      self.query_time += query_time
+      self.parse_time += parse_time
+
+  # Share of the rule targets of query outputs which were not parsed again
+  def reuse_ratio(self) -> float:
+    total_nodes: int = self.parsed_nodes + self.reused_nodes
+    return self.reused_nodes / total_nodes if total_nodes else 0.0
+
+
+# Measures the time spent waiting for the items of the wrapped iterable, i.e.
+# for bazel to produce the next piece of the streamed query output.
+class _TimedIterable:
+  def __init__(self, items: Iterable[Any]) -> None:
+    self._items: Iterable[Any] = items
+    self.elapsed: float = 0.0
+
+  def __iter__(self) -> Iterator[Any]:
+    items: Iterator[Any] = iter(self._items)
+    while True:
+      start: float = time.monotonic()
+      try:
+        item: Any = next(items)
+      except StopIteration:
+        return
+      finally:
+        self.elapsed += time.monotonic() - start
+      yield item
+
+
+# Splits wide frontiers into chunks and queries them concurrently. Each worker
+# owns a separate output base (i.e. a separate bazel server), otherwise bazel
+# would serialize the queries on the server lock.
+class ChunkedTargetsCollector(TargetsCollector):
+  def __init__(self, runner: BazelRunner,
+      bazel_query_parser: BazelBuildTargetsParser, jobs: int,
+      output_base_root: str = "", min_chunk_size: int = 500,
+      query_output: str = "build", infer_label_kinds: bool = False,
+      query_command: str = "cquery", parse_jobs: int = 1) -> None:
+    super().__init__(runner, bazel_query_parser, "", query_output,
+                     infer_label_kinds, query_command, parse_jobs)
+    if jobs < 1 or min_chunk_size < 1:
+      raise ValueError(
+          f"Invalid chunking: jobs = {jobs}, min_chunk_size = {min_chunk_size}")
+    self._jobs: int = jobs
+    self._min_chunk_size: int = min_chunk_size
+    # Free output bases, a worker takes one for the duration of a chunk query.
+    # Without output_base_root all chunks share the default output base and
+    # only parsing runs in parallel.
+    self._output_bases: Queue = Queue()
+    for i in range(jobs):
+      self._output_bases.put(f"{output_base_root}/job_{i}"
+                             if output_base_root else "")
+
+  def _query_deps(self, targets: List[str], bazel_config: str,
+      excluded_targets: List[str], skipped_labels: Set[str],
+      known_labels: Set[str]) -> Tuple[Dict[str, TargetNode], Set[str]]:
+    chunks_count: int = min(self._jobs,
+                            math.ceil(len(targets) / self._min_chunk_size))
+    # Sorted, so the same frontier always produces the same chunks (and the
+    # same cache keys)
+    chunks: List[List[str]] = list(self._split_into_chunks(
+        sorted(targets), math.ceil(len(targets) / chunks_count)))
+
+    internal_nodes: Dict[str, TargetNode] = {}
+    source_labels: Set[str] = set()
+    with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+      futures: Dict[Future, int] = {}
+      for i, chunk in enumerate(chunks):
+        futures[executor.submit(self._query_chunk, chunk, bazel_config,
+                                excluded_targets, known_labels)] = i
+      for future in as_completed(futures):
+        chunk_internal_nodes: Dict[str, TargetNode]
+        chunk_source_labels: Set[str]
+        chunk_skipped_labels: Set[str]
+        elapsed: float
+        chunk_internal_nodes, chunk_source_labels, chunk_skipped_labels, \
+        elapsed = future.result()
+        internal_nodes.update(chunk_internal_nodes)
+        source_labels.update(chunk_source_labels)
+        skipped_labels.update(chunk_skipped_labels)
+        i = futures[future]
+        print(f"    Chunk {i + 1}/{len(chunks)}: {len(chunks[i])} targets, "
+              f"{len(chunk_internal_nodes)} nodes, {elapsed:.1f}s")
+    return internal_nodes, source_labels
+
+  def _query_chunk(self, targets: List[str], bazel_config: str,
+      excluded_targets: List[str], known_labels: Set[str]) -> Tuple[
+    Dict[str, TargetNode], Set[str], Set[str], float]:
+    start: float = time.monotonic()
+    output_base: str = self._output_bases.get()
+    try:
+      skipped_labels: Set[str] = set()
+      internal_nodes: Dict[str, TargetNode] = self._query_build(
+          targets, bazel_config, excluded_targets, output_base, skipped_labels,
+          known_labels)
+      source_labels: Set[str] = set()
+      if not self._infer_label_kinds:
+        source_labels = self._query_source_files(targets, bazel_config,
+                                                excluded_targets, output_base)
+    finally:
+      self._output_bases.put(output_base)
+    return internal_nodes, source_labels, skipped_labels, \
+      time.monotonic() - start
+
+  def _split_into_chunks(self, targets: List[str], chunk_size: int) -> Iterable[
+    List[str]]:
+    if len(targets) <= chunk_size:
+      yield targets
+      return
+    cur_chunk: List[str] = []
+    for target in targets:
+      if len(cur_chunk) >= chunk_size:
+        yield cur_chunk
+        cur_chunk = []
+      cur_chunk.append(target)
+    if cur_chunk:
+      yield cur_chunk
@@ -0,0 +1,180 @@
+import re
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Match
+from typing import Optional
+from typing import Pattern
+from typing import Set
+
+from buildcleaner.proto import QueryRule
+from buildcleaner.rule import Rule
+
+
+# Decoder of bazel query --output=build blocks into QueryRule records. Holds no
+# nodes and no locks, so it can be sent to worker processes as is.
+class BuildOutputDecoder:
+  # Targets incompatible with the target platform are skipped
+  _INCOMPATIBLE_ATTR: str = \
+    'target_compatible_with = ["@platforms//:incompatible"]'
+  # Outputs are decoded for the targets without nodes too (ignored, unknown or
+  # incompatible), so they are not taken for source files.
+  _SKIPPED_ATTRS: Set[str] = {"name", "out", "outs"}
+
+  def __init__(self, path_prefix: str, rules_to_parse: Dict[str, Rule],
+      rules_to_ignore: Dict[str, Rule], lazy_attrs: bool = False) -> None:
+    self._lazy_attrs: bool = lazy_attrs
+    self._package_name_regex: Pattern = re.compile(
+        fr"#\s*{path_prefix}/(?P<value>[0-9a-zA-Z\-\._\@/]+)/BUILD(.bazel)?:")
+    # Location of targets of external repositories in the output base
+    self._external_package_regex: Pattern = re.compile(
+        r"#\s*\S*/external/(?P<repo>[^/\s]+)(?:/(?P<package>\S+?))?"
+        r"/BUILD(.bazel)?:")
+
+    # String literals are matched with their escape sequences, values are kept
+    # escaped, the way they are written in BUILD files.
+    self._string_literal_regex: Pattern = re.compile(r'"((?:[^"\\]|\\.)*)"')
+    self._string_pair_regex: Pattern = re.compile(
+        r'"((?:[^"\\]|\\.)*)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+    # Attributes to decode from build output blocks of each rule kind, the rest
+    # of the attributes are skipped without looking at their values
+    self._decoded_attrs: Dict[str, Set[str]] = {}
+    for rule in rules_to_ignore.values():
+      self._decoded_attrs[rule.kind] = BuildOutputDecoder._SKIPPED_ATTRS
+    for rule in rules_to_parse.values():
+      self._decoded_attrs[rule.kind] = {"name"}
+      self._decoded_attrs[rule.kind].update(
+          ["generator_name", "generator_function"], rule.label_list_args,
+          rule.label_args, rule.string_list_args, rule.string_args,
+          rule.bool_args, rule.int_args, rule.str_str_map_args,
+          rule.out_label_list_args, rule.out_label_args)
+    # Attributes decoded right away in lazy mode: the ones which reference other
+    # targets or declare outputs, i.e. everything needed to build the graph
+    self._eager_attrs: Dict[str, Set[str]] = self._decoded_attrs
+    if lazy_attrs:
+      self._eager_attrs = {}
+      for rule in rules_to_ignore.values():
+        self._eager_attrs[rule.kind] = BuildOutputDecoder._SKIPPED_ATTRS
+      for rule in rules_to_parse.values():
+        self._eager_attrs[rule.kind] = {"name"}
+        self._eager_attrs[rule.kind].update(
+            ["generator_name", "generator_function"], rule.label_list_args,
+            rule.label_args, rule.out_label_list_args, rule.out_label_args)
+
+  # In lazy mode only the label attributes are decoded, the block itself is
+  # kept in the result to decode the rest later.
+  def decode_block(self, target_rule: str) -> Optional[QueryRule]:
+    return self._decode_block(target_rule, self._lazy_attrs)
+
+  # All the attributes of the rule schema, including the ones lazy mode skips
+  def decode_block_attributes(self, target_rule: str) -> Dict[str, Any]:
+    query_rule: Optional[QueryRule] = self._decode_block(target_rule, False)
+    return query_rule.attributes if query_rule else {}
+
+  # Walks the block once: location comment, "kind(" line and then one
+  # "attr = value," line per attribute. Only the attributes of the rule schema
+  # are decoded. Blocks of external (except bind) and incompatible targets are
+  # rejected right after the header.
+  def _decode_block(self, target_rule: str,
+      lazy: bool) -> Optional[QueryRule]:
+    if "\r" in target_rule:
+      target_rule = target_rule.replace("\r", "")
+    lines: List[str] = target_rule.split("\n")
+    location: str = ""
+    kind: str = ""
+    body_start: int = 0
+    for body_start, line in enumerate(lines, 1):
+      if line.startswith("#"):
+        if not location:
+          location = line
+      elif line.endswith("("):
+        kind = line[:-1]
+        break
+    if not kind:
+      return None
+
+    # Cheap checks of the header and the raw block go first, rejected targets
+    # have nothing but their name and outputs decoded (and external ones not
+    # even that).
+    rule_pkg: Optional[Match[str]] = self._package_name_regex.match(location)
+    if not rule_pkg and kind != "bind":
+      return QueryRule(kind, self._external_label(location, target_rule),
+                       location, {}, QueryRule.EXTERNAL)
+    rejected: str = ""
+    decoded_attrs: Set[str]
+    if BuildOutputDecoder._INCOMPATIBLE_ATTR in target_rule:
+      rejected = QueryRule.INCOMPATIBLE
+      decoded_attrs = BuildOutputDecoder._SKIPPED_ATTRS
+    else:
+      decoded_attrs = (self._eager_attrs if lazy else self._decoded_attrs).get(
+          kind, BuildOutputDecoder._SKIPPED_ATTRS)
+    attributes: Dict[str, Any] = {}
+    for line in lines[body_start:]:
+      if line == ")":
+        break
+      attr_name, sep, value = line.partition(" = ")
+      attr_name = attr_name.strip()
+      if not sep or attr_name not in decoded_attrs:
+        continue
+      decoded_value: Any = self._decode_value(
+          value[:-1] if value.endswith(",") else value)
+      if decoded_value is not None:
+        attributes[attr_name] = decoded_value
+
+    name: Any = attributes.get("name")
+    if not name or not isinstance(name, str):
+      return None
+    label: str = f"//{rule_pkg.group('value')}:{name}" if rule_pkg \
+      else f"//external:{name}"
+    if rejected:
+      return QueryRule(kind, label, location, attributes, rejected)
+    return QueryRule(kind, label, location, attributes,
+                     raw_block=target_rule if lazy else "")
+
+  # Label of an external target, so it can be excluded from the next queries.
+  # Empty if the location is not in an external repository.
+  def _external_label(self, location: str, target_rule: str) -> str:
+    repo_pkg: Optional[Match[str]] = self._external_package_regex.match(
+        location)
+    name_start: int = target_rule.find('\n  name = "')
+    if not repo_pkg or name_start < 0:
+      return ""
+    name_start += len('\n  name = "')
+    name: str = target_rule[name_start:target_rule.find('"', name_start)]
+    repo: str = repo_pkg.group("repo")
+    # Canonical names of bzlmod repositories are not valid apparent names
+    repo_prefix: str = "@@" if "~" in repo or "+" in repo else "@"
+    return f"{repo_prefix}{repo}//{repo_pkg.group('package') or ''}:{name}"
+
+  # Strings (and strings in lists and dicts) are returned in escaped form,
+  # values which are neither literals nor lists/dicts of string literals (e.g.
+  # select()) are not decoded.
+  def _decode_value(self, value: str) -> Any:
+    if not value:
+      return None
+    first: str = value[0]
+    last: str = value[-1]
+    if first == '"':
+      return value[1:-1] if len(value) > 1 and last == '"' else None
+    if first == "[":
+      return self._string_literal_regex.findall(value) if last == "]" else None
+    if first == "{":
+      return dict(
+          self._string_pair_regex.findall(value)) if last == "}" else None
+    if value == "True":
+      return True
+    if value == "False":
+      return False
+    try:
+      return int(value)
+    except ValueError:
+      return None
+
+
+# Entry point of worker processes of parallel parsing. Both arguments and
+# result are plain picklable data, nodes are built by the parent process. The
+# result has a decoded rule (or None) for every block.
+def decode_build_blocks_shard(decoder: BuildOutputDecoder,
+    target_rules: List[str]) -> List[Optional[QueryRule]]:
+  return [decoder.decode_block(t) if t else None for t in target_rules]
@@ -0,0 +1,435 @@
+import gzip
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+from collections import deque
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Set
+from typing import Tuple
+from typing import cast
+
+from buildcleaner.proto import QueryRule
+from buildcleaner.rule import Rule
+
+
+# Content-addressed on-disk cache of bazel query outputs. Entries are gzip
+# compressed and are keyed by a hash of everything the output depends on. The
+# cache is bounded both by total size and by age of its entries, least recently
+# used entries are evicted first.
+class QueryCache:
+  _ENTRY_SUFFIX: str = ".gz"
+
+  def __init__(self, cache_path: str, max_size_mb: int = 4096,
+      max_age_days: int = 7) -> None:
+    self._cache_path: str = cache_path
+    self._max_size: int = max_size_mb * 1024 * 1024
+    self._max_age: float = max_age_days * 24 * 60 * 60
+    self._evict_lock: threading.Lock = threading.Lock()
+    self._evicted: bool = False
+
+  def key(self, key_parts: Iterable[str]) -> str:
+    key_hash = hashlib.sha256()
+    for key_part in key_parts:
+      key_hash.update(key_part.encode("utf-8"))
+      # Separator, so ("ab", "c") and ("a", "bc") have different keys
+      key_hash.update(b"\0")
+    return key_hash.hexdigest()
+
+  def get(self, key: str) -> Optional[bytes]:
+    entry: Optional[gzip.GzipFile] = self.open_reader(key)
+    if entry is None:
+      return None
+    with entry:
+      return entry.read()
+
+  def put(self, key: str, data: bytes) -> None:
+    entry_writer: QueryCacheEntryWriter = self.open_writer(key)
+    entry_writer.write(data)
+    entry_writer.commit()
+
+  def open_reader(self, key: str) -> Optional[gzip.GzipFile]:
+    entry_path: str = self._entry_path(key)
+    try:
+      entry: gzip.GzipFile = gzip.GzipFile(entry_path, "rb")
+    except FileNotFoundError:
+      return None
+    # Mark entry as recently used, eviction relies on it
+    os.utime(entry_path)
+    return entry
+
+  def open_writer(self, key: str) -> "QueryCacheEntryWriter":
+    self._evict_once()
+    entry_path: str = self._entry_path(key)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    return QueryCacheEntryWriter(self, entry_path)
+
+  def get_value(self, name: str) -> Optional[str]:
+    value: Optional[bytes] = self.get(self.key(["__value__", name]))
+    return value.decode("utf-8") if value is not None else None
+
+  def put_value(self, name: str, value: str) -> None:
+    self.put(self.key(["__value__", name]), value.encode("utf-8"))
+
+  # The whole cache is walked to evict entries, so it is done once per run,
+  # before the first entry of the run is written.
+  def _evict_once(self) -> None:
+    with self._evict_lock:
+      if not self._evicted:
+        self._evicted = True
+        self._evict()
+
+  # Other runs (or other jobs of this one) may remove or replace entries at
+  # the same time, so entries which are gone already are skipped.
+  def _evict(self) -> None:
+    now: float = time.time()
+    entries: List[Tuple[float, int, str]] = []
+    for dir_path, _, file_names in os.walk(self._cache_path):
+      for file_name in file_names:
+        if not file_name.endswith(QueryCache._ENTRY_SUFFIX):
+          continue
+        entry_path: str = os.path.join(dir_path, file_name)
+        try:
+          entry_stat: os.stat_result = os.stat(entry_path)
+        except FileNotFoundError:
+          continue
+        if now - entry_stat.st_mtime > self._max_age:
+          self._remove_entry(entry_path)
+          continue
+        entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+
+    total_size: int = sum(e[1] for e in entries)
+    entries.sort()
+    for _, entry_size, entry_path in entries:
+      if total_size <= self._max_size:
+        break
+      self._remove_entry(entry_path)
+      total_size -= entry_size
+
+  def _remove_entry(self, entry_path: str) -> None:
+    try:
+      os.remove(entry_path)
+    except FileNotFoundError:
+      pass
+
+  def _entry_path(self, key: str) -> str:
+    return os.path.join(self._cache_path, key[:2],
+                        f"{key}{QueryCache._ENTRY_SUFFIX}")
+
+
+# Writes an entry incrementally, the entry becomes visible in the cache only
+# once committed.
+class QueryCacheEntryWriter:
+  def __init__(self, query_cache: QueryCache, entry_path: str) -> None:
+    self._query_cache: QueryCache = query_cache
+    self._entry_path: str = entry_path
+    self._tmp_entry_path: str = \
+      f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    self._entry: gzip.GzipFile = gzip.GzipFile(self._tmp_entry_path, "wb")
+
+  def write(self, data: bytes) -> None:
+    self._entry.write(data)
+
+  def commit(self) -> None:
+    self._entry.close()
+    os.replace(self._tmp_entry_path, self._entry_path)
+
+  def discard(self) -> None:
+    self._entry.close()
+    os.remove(self._tmp_entry_path)
+
+
+# Hash of the files which define build graph of a bazel workspace, along with
+# the names of all the other files, as glob() results depend on them
+class WorkspaceFingerprint:
+  _BUILD_FILE_NAMES: Tuple[str, ...] = ("BUILD", "BUILD.bazel", "WORKSPACE",
+                                        "WORKSPACE.bazel", "MODULE.bazel",
+                                        ".bazelrc", ".bazelversion")
+
+  def __init__(self, workspace_path: str) -> None:
+    self._workspace_path: str = workspace_path
+
+  def compute(self) -> str:
+    fingerprint = hashlib.sha256()
+    for dir_path, dir_names, file_names in os.walk(self._workspace_path):
+      # bazel-* are symlinks to output directories, hidden dirs are VCS/IDE
+      # metadata, neither defines build graph.
+      dir_names[:] = sorted(d for d in dir_names if
+                            not d.startswith("bazel-") and not d.startswith(
+                                "."))
+      # Adding or removing a source file changes glob() results, and so the
+      # query output, contents of source files do not matter
+      fingerprint.update(
+          os.path.relpath(dir_path, self._workspace_path).encode("utf-8"))
+      fingerprint.update("\0".join(sorted(file_names)).encode("utf-8"))
+      fingerprint.update(b"\0")
+      for file_name in sorted(file_names):
+        if file_name not in WorkspaceFingerprint._BUILD_FILE_NAMES and \
+            not file_name.endswith(".bzl"):
+          continue
+        file_path: str = os.path.join(dir_path, file_name)
+        fingerprint.update(
+            os.path.relpath(file_path, self._workspace_path).encode("utf-8"))
+        with open(file_path, "rb") as f:
+          fingerprint.update(hashlib.sha256(f.read()).digest())
+    return fingerprint.hexdigest()
+
+
+# Decoded targets of build output, cached per package in a query cache. The
+# packages of a scope are kept in a single entry, each one along with a hash
+# of its BUILD file, of the .bzl files it loads (transitively) and of the names
+# of its files. A package is checked once per run, so the targets of unchanged
+# packages are never decoded again, even if the query output itself is not
+# cached. Targets are looked up by the location comment and the name of their
+# blocks.
+class PackageParseCache:
+  _UNPICKLED_PACKAGES_COUNT: int = 16
+
+  def __init__(self, query_cache: QueryCache, workspace_path: str,
+      rules: Iterable[Rule], scope: Iterable[str] = ()) -> None:
+    self._query_cache: QueryCache = query_cache
+    self._workspace_path: str = os.path.join(os.path.abspath(workspace_path),
+                                             "")
+    # Hashes of the files read so far and the loads of them, by paths
+    self._files: Dict[str, Tuple[str, List[str]]] = {}
+    self._load_regex: Pattern = re.compile(
+        r"""^load\(\s*(?:"([^"]+)"|'([^']+)')""", re.M)
+    # Everything but the package files the decoded targets depend on: the
+    # attributes decoded for each rule kind, and the caller's scope (e.g.
+    # bazel config and command), along with the workspace level files.
+    scope_parts: List[str] = list(scope)
+    for rule in sorted(rules, key=lambda r: r.kind):
+      scope_parts.append(":".join([rule.kind, *rule.label_list_args,
+                                   *rule.label_args, *rule.string_list_args,
+                                   *rule.string_args, *rule.bool_args,
+                                   *rule.int_args, *rule.str_str_map_args,
+                                   *rule.out_label_list_args,
+                                   *rule.out_label_args]))
+    for file_name in ("WORKSPACE", "WORKSPACE.bazel", "MODULE.bazel",
+                      ".bazelrc"):
+      scope_parts.append(self._read_file(
+          os.path.join(self._workspace_path, file_name))[0])
+    self._scope_key: str = query_cache.key(scope_parts)
+    # All the packages ever parsed in the scope, by BUILD file paths. Loaded
+    # from the query cache on first use.
+    self._packages: Optional[Dict[str, _PackageEntry]] = None
+    # BUILD file paths of the packages checked against their files in this run
+    self._checked_packages: Set[str] = set()
+    # Packages with unpickled records which are not changed, the least
+    # recently unpickled first
+    self._unpickled_packages: Deque[_PackageEntry] = deque()
+    self._lock: threading.Lock = threading.Lock()
+
+  def lookup(self, target_rule: str) -> Optional[QueryRule]:
+    build_file_path: str = self._build_file_path(target_rule)
+    if not build_file_path:
+      return None
+    name_start: int = target_rule.find('\n  name = "')
+    if name_start < 0:
+      return None
+    name_start += len('\n  name = "')
+    name: str = target_rule[name_start:target_rule.find('"', name_start)]
+    with self._lock:
+      record: Optional[List[Any]] = self._records(
+          self._package(build_file_path)).get(name)
+    if record is None:
+      return None
+    return QueryRule(*record)
+
+  def add(self, query_rule: QueryRule) -> None:
+    if query_rule.raw_block:
+      # Attributes are incomplete
+      return
+    build_file_path: str = self._build_file_path(query_rule.location)
+    if not build_file_path:
+      return
+    name: str = query_rule.label.rpartition(":")[2]
+    with self._lock:
+      package: _PackageEntry = self._package(build_file_path)
+      self._records(package)[name] = [
+          query_rule.kind, query_rule.label, query_rule.location,
+          query_rule.attributes, query_rule.rejected]
+      package.dirty = True
+
+  # Writes the packages to the query cache if any changed since the last flush
+  def flush(self) -> None:
+    with self._lock:
+      if self._packages is None or not any(
+          p.dirty for p in self._packages.values()):
+        return
+      for package in self._packages.values():
+        if package.dirty:
+          package.pickled_records = pickle.dumps(
+              package.records, pickle.HIGHEST_PROTOCOL)
+          package.records = None
+          package.dirty = False
+      packages: Dict[str, Tuple[str, bytes]] = {
+          build_file_path: (package.package_hash, package.pickled_records)
+          for build_file_path, package in self._packages.items()}
+      self._query_cache.put(self._packages_key(), pickle.dumps(
+          packages, pickle.HIGHEST_PROTOCOL))
+
+  # Entry of a package, emptied if the package files changed since its
+  # targets were cached. Each package is checked once per run.
+  def _package(self, build_file_path: str) -> "_PackageEntry":
+    if self._packages is None:
+      self._packages = {}
+      cached_packages: Optional[bytes] = self._query_cache.get(
+          self._packages_key())
+      if cached_packages is not None:
+        for path, (cached_hash, pickled_records) in pickle.loads(
+            cached_packages).items():
+          self._packages[path] = _PackageEntry(cached_hash, pickled_records)
+    package: Optional[_PackageEntry] = self._packages.get(build_file_path)
+    if build_file_path in self._checked_packages:
+      return cast(_PackageEntry, package)
+    self._checked_packages.add(build_file_path)
+    package_hash: str = self._package_hash(build_file_path)
+    if package is None or package.package_hash != package_hash:
+      package = _PackageEntry(package_hash, b"")
+      package.records = {}
+      package.dirty = True
+      self._packages[build_file_path] = package
+    return package
+
+  # Records of a package, unpickled on demand. Blocks of a package come
+  # together, so only a few recently used packages keep their records: the
+  # records of all the packages would be a lot of objects for the garbage
+  # collector to track for the whole run.
+  def _records(self, package: "_PackageEntry") -> Dict[str, List[Any]]:
+    if package.records is not None:
+      return package.records
+    package.records = pickle.loads(package.pickled_records)
+    self._unpickled_packages.append(package)
+    if len(self._unpickled_packages) > \
+        PackageParseCache._UNPICKLED_PACKAGES_COUNT:
+      evicted_package: _PackageEntry = self._unpickled_packages.popleft()
+      if not evicted_package.dirty:
+        evicted_package.records = None
+    return package.records
+
+  def _packages_key(self) -> str:
+    return self._query_cache.key(["__packages__", "4", self._scope_key])
+
+  # The BUILD file of a block's location comment (or of a location itself),
+  # empty if it is not in the workspace
+  def _build_file_path(self, target_rule: str) -> str:
+    if not target_rule.startswith("# "):
+      return ""
+    location: str = target_rule[2:target_rule.find("\n")] \
+      if "\n" in target_rule else target_rule[2:]
+    build_file_path: str = location.rsplit(":", 2)[0]
+    if not build_file_path.startswith(self._workspace_path):
+      return ""
+    return build_file_path
+
+  # Hash of everything the targets of a package depend on besides the scope:
+  # BUILD file, all the .bzl files it loads, transitively, and names of the
+  # files in the package, which glob() may match.
+  def _package_hash(self, build_file_path: str) -> str:
+    hasher = hashlib.sha256()
+    for file_hash in self._package_file_hashes(build_file_path):
+      hasher.update(file_hash.encode("utf-8"))
+      hasher.update(b"\0")
+    for file_name in self._package_file_names(
+        os.path.dirname(build_file_path)):
+      hasher.update(file_name.encode("utf-8", "surrogateescape"))
+      hasher.update(b"\0")
+    return hasher.hexdigest()
+
+  # Paths of the files under a package directory, relative to it, without
+  # the ones of its subpackages
+  def _package_file_names(self, package_path: str) -> List[str]:
+    file_names: List[str] = []
+    pending: List[str] = [""]
+    while pending:
+      dir_path: str = pending.pop()
+      try:
+        entries: List[os.DirEntry] = list(
+            os.scandir(os.path.join(package_path, dir_path)))
+      except OSError:
+        continue
+      if dir_path and any(e.name in ("BUILD", "BUILD.bazel") for e in entries):
+        # Subpackage
+        continue
+      for entry in entries:
+        entry_path: str = os.path.join(dir_path, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+          pending.append(entry_path)
+        else:
+          file_names.append(entry_path)
+    return sorted(file_names)
+
+  # Hashes of BUILD file and of all the .bzl files it loads, transitively
+  def _package_file_hashes(self, build_file_path: str) -> List[str]:
+    hashes: List[str] = []
+    visited: Set[str] = set()
+    pending: List[Tuple[str, str]] = [
+        (build_file_path, os.path.dirname(build_file_path))]
+    while pending:
+      file_path, package_path = pending.pop()
+      if file_path in visited:
+        continue
+      visited.add(file_path)
+      file_hash: str
+      loads: List[str]
+      file_hash, loads = self._read_file(file_path)
+      hashes.append(f"{file_path}:{file_hash}")
+      for load in loads:
+        if load.startswith("@") and not load.startswith("@//"):
+          # External repositories are pinned by workspace files, which are
+          # part of the scope.
+          hashes.append(load)
+          continue
+        loaded_path, loaded_package_path = self._load_path(load, package_path)
+        pending.append((loaded_path, loaded_package_path))
+    return hashes
+
+  # Path of a loaded .bzl file and of the package it belongs to. Relative
+  # labels (":defs.bzl") are relative to the package of the loading file.
+  def _load_path(self, load: str, package_path: str) -> Tuple[str, str]:
+    load = load[1:] if load.startswith("@//") else load
+    package: str
+    name: str
+    package, _, name = load.rpartition(":")
+    if package.startswith("//"):
+      package_path = os.path.join(self._workspace_path, package[2:])
+    return os.path.join(package_path, name), package_path
+
+  # Hash of a file and the labels of the files it loads, read once per run.
+  # Missing files have an empty hash.
+  def _read_file(self, file_path: str) -> Tuple[str, List[str]]:
+    file: Optional[Tuple[str, List[str]]] = self._files.get(file_path)
+    if file is not None:
+      return file
+    try:
+      with open(file_path, "rb") as f:
+        content: bytes = f.read()
+      file = (hashlib.sha256(content).hexdigest(), [
+          double_quoted or single_quoted for double_quoted, single_quoted in
+          self._load_regex.findall(content.decode("utf-8", "replace"))])
+    except OSError:
+      file = ("", [])
+    self._files[file_path] = file
+    return file
+
+
+class _PackageEntry:
+  def __init__(self, package_hash: str, pickled_records: bytes) -> None:
+    # Hash of the package files the records were decoded with
+    self.package_hash: str = package_hash
+    # Fields of the decoded targets of the package, by names, as they are
+    # stored in the query cache
+    self.pickled_records: bytes = pickled_records
+    # The same unpickled, None until used
+    self.records: Optional[Dict[str, List[Any]]] = None
+    # Has records which are not pickled yet
+    self.dirty: bool = False
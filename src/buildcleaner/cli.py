@@ -7,8 +7,10 @@ from typing import Optional
 from typing import cast
 
 from buildcleaner.build import Build
+from buildcleaner.cache import QueryCache
 from buildcleaner.config import Config
 from buildcleaner.config import DebugTargetGraph
+from buildcleaner.config import QueryCacheConfig
 from buildcleaner.fileio import BuildFilesWriter
 from buildcleaner.fileio import ConfigFileReader
 from buildcleaner.fileio import GraphvizWriter
@@ -19,19 +21,28 @@ from buildcleaner.node import TargetNode
 from buildcleaner.printer import BuildFilesPrinter
 from buildcleaner.printer import DebugTreePrinter
 from buildcleaner.printer import GraphPrinter
+from buildcleaner.runner import BazelRunner
 
 
 class BuildCleanerCli:
   def __init__(self, cli_args: List[str]) -> None:
     self._config: Config
+    self._query_cache: Optional[QueryCache] = None
+    replay: bool = False
 
     for cli_arg in cli_args:
+      if cli_arg == "--replay":
+        replay = True
+        continue
       arg_name: str
       arg_val: str
       arg_name, arg_val = cli_arg.split("=", maxsplit=2)
       if arg_name == "--config":
         self._config = ConfigFileReader().read(arg_val)
 
+    if replay:
+      self._config.query_cache.replay = True
+
   def main(self) -> None:
     start: float = time.time()
 
@@ -57,6 +68,27 @@ class BuildCleanerCli:
   def generate_build(self) -> Build:
     pass
 
+  def create_bazel_runner(self) -> BazelRunner:
+    cache_config: QueryCacheConfig = self._config.query_cache
+    query_cache: Optional[QueryCache] = self.create_query_cache()
+    if not query_cache:
+      if cache_config.replay:
+        raise ValueError("Replay mode requires query_cache.path to be set")
+      return BazelRunner()
+    return BazelRunner(query_cache, self._config.prefix_path,
+                       cache_config.replay)
+
+  # One cache is shared by the runner and the package parse cache
+  def create_query_cache(self) -> Optional[QueryCache]:
+    cache_config: QueryCacheConfig = self._config.query_cache
+    if not cache_config.path:
+      return None
+    if not self._query_cache:
+      self._query_cache = QueryCache(cache_config.path,
+                                     cache_config.max_size_mb,
+                                     cache_config.max_age_days)
+    return self._query_cache
+
   def _generate_build_files(self, repo: RepositoryNode,
       output_build_path: str, build_file_name: str) -> None:
     print(f"\n>>>>> Generating Build Files in '{output_build_path}' ...")
@@ -14,6 +14,7 @@ class Config:
     self.debug_tree: bool = False
     self.merged_targets: MergedTargetsConfig = MergedTargetsConfig()
     self.artifact_targets: ArtifactTargetsConfig = ArtifactTargetsConfig()
+    self.query_cache: QueryCacheConfig = QueryCacheConfig()
 
 
 class BaseTargetsConfig:
@@ -21,6 +22,34 @@ class BaseTargetsConfig:
     self.target: str = ""
     self.excluded_targets: List[str] = []
     self.bazel_config: str = ""
+    # If set, label_kind query runs concurrently with build query in a
+    # separate bazel server using this output base.
+    self.secondary_output_base: str = ""
+    # Output format to collect targets from: "build", "streamed_proto" or
+    # "jsonproto".
+    self.query_output: str = "build"
+    # Infer source files from build output instead of running label_kind
+    # query on every round.
+    self.infer_label_kinds: bool = False
+    # Bazel command to collect targets with: "cquery" or "query". Query skips
+    # analysis phase and is much faster, rules with select() in their
+    # attributes are still collected with cquery. Requires "build" output.
+    self.query_command: str = "cquery"
+    # Number of concurrent deps queries, wide frontiers are split into up to
+    # this many chunks of at least min_chunk_size targets each.
+    self.jobs: int = 1
+    self.min_chunk_size: int = 500
+    # Each job gets its own output base under this directory, so chunk
+    # queries do not wait for each other on bazel server lock.
+    self.output_base_root: str = ""
+    # Number of processes decoding build output, blocks of the output are
+    # decoded in parallel if greater than 1. Nodes are still built by the main
+    # process.
+    self.parse_jobs: int = 1
+    # Decode only label attributes of build output right away, value
+    # attributes (copts, tags, etc.) are decoded on their first use, which
+    # targets removed before printing never have.
+    self.lazy_attrs: bool = False
 
 
 class ArtifactTargetsConfig:
@@ -39,3 +68,14 @@ class DebugTargetGraph:
   def __init__(self) -> None:
     self.path: str = ""
     self.targets: List[str] = []
+
+
+class QueryCacheConfig:
+  def __init__(self) -> None:
+    self.path: str = ""
+    self.max_size_mb: int = 4096
+    self.max_age_days: int = 7
+    self.replay: bool = False
+    # Also cache decoded build output targets per package, keyed by the content
+    # of BUILD and loaded .bzl files
+    self.packages: bool = False
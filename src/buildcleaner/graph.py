@@ -1,13 +1,12 @@
-import re
 from typing import Dict
 from typing import Iterable
 from typing import List
 from typing import Optional
-from typing import Pattern
 from typing import Set
 from typing import Tuple
 from typing import cast
 
+from buildcleaner.label import Label
 from buildcleaner.node import ContainerNode
 from buildcleaner.node import FileNode
 from buildcleaner.node import GeneratedFileNode
@@ -41,7 +40,8 @@ class TargetDag:
       if not to_target.is_external():
         actual_to_target: TargetNode = to_target
         if isinstance(to_target, GeneratedFileNode):
-          actual_to_target = cast(GeneratedFileNode, to_target).maternal_target
+          # Generated files always have their maternal target set
+          actual_to_target = cast(TargetNode, to_target.maternal_target)
         if not isinstance(actual_to_target, FileNode):
           visited[from_target].add(actual_to_target)
           if reverse_visited is not None:
@@ -89,16 +89,16 @@ class TargetDag:
         continue
       target_node = cast(TargetNode, node)
       if target_node.is_stub() and not target_node.is_external():
-        if self._node_belongs_to_excluded_package(target_node,
-                                                  excluded_package_prefixes):
+        if self.node_belongs_to_excluded_package(target_node,
+                                                 excluded_package_prefixes):
           unresolved_targets.setdefault(target_node, []).append(str(node))
         else:
           alien_targets.setdefault(target_node, []).append(str(node))
 
       for ref_target in target_node.get_targets():
         if ref_target.is_stub() and not ref_target.is_external():
-          if self._node_belongs_to_excluded_package(ref_target,
-                                                    excluded_package_prefixes):
+          if self.node_belongs_to_excluded_package(ref_target,
+                                                   excluded_package_prefixes):
             unresolved_targets.setdefault(ref_target, []).append(str(node))
           else:
             alien_targets.setdefault(ref_target, []).append(str(node))
@@ -115,27 +115,28 @@ class TargetDag:
 
     return unresolved_targets
 
-  def _node_belongs_to_excluded_package(self, node: TargetNode,
+  @staticmethod
+  def node_belongs_to_excluded_package(node: TargetNode,
       excluded_package_prefixes: List[str]) -> bool:
     for excluded_package_prefix in excluded_package_prefixes:
       if node.label.startswith(excluded_package_prefix):
-        if node.label[len(excluded_package_prefix)] in [":", "/"]:
+        # A label equal to the prefix has nothing after it
+        if node.label[len(excluded_package_prefix):len(
+            excluded_package_prefix) + 1] in [":", "/"]:
           return True
     return False
 
 
 class PackageTree:
-  def __init__(self) -> None:
-    self._label_splitter_regex: Pattern = re.compile(
-        r"(?P<external>@?)(?P<repo>\w*)//(?P<package>[0-9a-zA-Z\-\._\@/]*):(?P<name>[0-9a-zA-Z\-\._\+/]+)$")
-
   def get_label_components(self, label: str) -> Tuple[bool, str, str, str]:
-    match = self._label_splitter_regex.search(label)
-    if not match:
+    parsed_label: Label = Label.parse(label)
+    if not parsed_label.is_target():
       raise ValueError(f"{label} is not a valid label")
-    return match.group("external") == "@", match.group("repo"), match.group(
-        "package"), match.group("name")
+    return parsed_label.external, parsed_label.repo, parsed_label.package, \
+      parsed_label.name
 
+  # Nodes of one package are best passed one after another (e.g. sorted by
+  # label), each next node of the same package is then attached right away.
   def build_package_tree(self, target_nodes_list: Iterable[Node]) -> Tuple[
     RootNode, RootNode]:
     external_root = RootNode("@")
@@ -144,35 +145,43 @@ class PackageTree:
         external_root.label: external_root,
         internal_root.label: internal_root
     }
+    package_label: Optional[str] = None
+    package_node: ContainerNode = internal_root
     for node in target_nodes_list:
-      external, repo, pkg, name = self.get_label_components(node.label)
-      root_node = external_root if external else internal_root
-      repo_node: RepositoryNode = RepositoryNode(repo, root_node.label)
-      if str(repo_node) not in all_containers:
-        root_node.children[str(repo_node)] = repo_node
-        all_containers[str(repo_node)] = repo_node
-      else:
-        repo_node = cast(RepositoryNode, all_containers[str(repo_node)])
-
-      folders = pkg.split("/") if pkg else []
-      container_node: ContainerNode = repo_node
-      all_containers[str(container_node)] = container_node
-      package_depth: int = 2
-      for folder in folders:
-        next_package_node: PackageNode = PackageNode(folder,
-                                                     str(container_node),
-                                                     package_depth)
-        next_package_node = cast(PackageNode,
-                                 all_containers.setdefault(
-                                     str(next_package_node),
-                                     next_package_node))
-        package_depth += 1
-        container_node.children[str(next_package_node)] = next_package_node
-        container_node = next_package_node
-      container_node.children[str(node)] = node
+      label: Label = node.parsed_label
+      if not label.is_target():
+        raise ValueError(f"{node.label} is not a valid label")
+      if label.package_label != package_label:
+        package_label = label.package_label
+        package_node = self._get_container(package_label, all_containers)
+      package_node.add_child(node)
 
     return internal_root, external_root
 
+  # Containers are created only if they do not exist yet, along with their
+  # missing parents
+  def _get_container(self, container_label: str,
+      all_containers: Dict[str, ContainerNode]) -> ContainerNode:
+    container_node: Optional[ContainerNode] = all_containers.get(
+        container_label)
+    if container_node is not None:
+      return container_node
+
+    label: Label = Label.parse(container_label)
+    if label.parent is None:
+      raise ValueError(f"{container_label} is not a valid label")
+    parent_node: ContainerNode = self._get_container(label.parent,
+                                                     all_containers)
+    if label.package:
+      container_node = PackageNode(label.package.rpartition("/")[2],
+                                   parent_node.label,
+                                   label.package.count("/") + 2)
+    else:
+      container_node = RepositoryNode(label.repo, parent_node.label)
+    parent_node.add_child(container_node)
+    all_containers[container_label] = container_node
+    return container_node
+
   def replace_targets(self, container: ContainerNode,
       new_targets: Dict[str, TargetNode]) -> None:
     children_to_replace: List[TargetNode] = []
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+from typing import Optional
+
+
+# Label of a target ("@repo//pkg:name") or of a container ("@repo//pkg",
+# "@repo//", or "" and "@" for the roots), split into its parts. Only the
+# offsets of the parts are kept and the parts are sliced out of the label on
+# access. Labels are not interned, a table of parsed labels would cost more
+# memory per node than the two find() calls it saves. Nodes parse their labels
+# on the first use and keep them (see Node.parsed_label).
+class Label:
+  __slots__ = ("label", "_repo_end", "_name_start")
+
+  def __init__(self, label: str) -> None:
+    self.label: str = label
+    # Negative for roots
+    self._repo_end: int = label.find("//")
+    # Negative for containers
+    self._name_start: int = label.rfind(":", self._repo_end + 2) \
+      if self._repo_end >= 0 else -1
+
+  def __str__(self) -> str:
+    return self.label
+
+  def __repr__(self) -> str:
+    return self.label
+
+  @property
+  def external(self) -> bool:
+    return self.label.startswith("@")
+
+  @property
+  def repo(self) -> str:
+    if self._repo_end < 0:
+      return ""
+    return self.label[1 if self.external else 0:self._repo_end]
+
+  @property
+  def package(self) -> str:
+    if self._repo_end < 0:
+      return ""
+    if self._name_start < 0:
+      return self.label[self._repo_end + 2:]
+    return self.label[self._repo_end + 2:self._name_start]
+
+  # Empty for containers
+  @property
+  def name(self) -> str:
+    return self.label[self._name_start + 1:] if self._name_start >= 0 else ""
+
+  # Label of the package of a target, the label itself for containers
+  @property
+  def package_label(self) -> str:
+    return self.label[:self._name_start] if self._name_start >= 0 \
+      else self.label
+
+  # None for roots
+  @property
+  def parent(self) -> Optional[str]:
+    if self._repo_end < 0:
+      return None
+    if self._name_start >= 0:
+      return self.label[:self._name_start]
+    package_start: int = self._repo_end + 2
+    if package_start == len(self.label):
+      # Repository, its parent is the global root
+      return "@" if self.external else ""
+    package_end: int = self.label.rfind("/")
+    # Top most package in a repo belongs to the repo, nested packages belong
+    # to their parent packages
+    return self.label[:package_start] if package_end < package_start \
+      else self.label[:package_end]
+
+  def is_target(self) -> bool:
+    return bool(self.name)
+
+  @staticmethod
+  def parse(label: str) -> Label:
+    return Label(label)
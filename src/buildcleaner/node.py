@@ -1,12 +1,16 @@
 from __future__ import annotations
 
+import threading
 from abc import abstractmethod
+from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import Iterable
 from typing import List
 from typing import Optional
 from typing import cast
 
+from buildcleaner.label import Label
 from buildcleaner.rule import BuiltInRules
 from buildcleaner.rule import Rule
 
@@ -19,6 +23,8 @@ class Function:
 
 
 class Node:
+  __slots__ = ("kind", "name", "label", "_parsed_label")
+
   @abstractmethod
   def __init__(self, kind: Rule, name: str, label: str) -> None:
     self.kind: Rule = kind
@@ -27,6 +33,8 @@ class Node:
 
     self.name = name
     self.label = label
+    # Parsed on the first use, labels of nodes never change
+    self._parsed_label: Optional[Label] = None
 
   def __str__(self) -> str:
     return self.label
@@ -54,103 +62,90 @@ class Node:
   def __hash__(self) -> int:
     return self.label.__hash__()
 
+  @property
+  def parsed_label(self) -> Label:
+    if self._parsed_label is None:
+      self._parsed_label = Label.parse(self.label)
+    return self._parsed_label
+
   def get_parent_label(self) -> str:
-    return self._get_parent_label(self.label)
+    parent_label: Optional[str] = self.parsed_label.parent
+    if parent_label is None:
+      raise LookupError("Root node cannonot have a parrent")
+    return parent_label
 
   def _get_parent_label(self, label: str) -> str:
-    package_label_index: int = label.rfind(":")
-    if package_label_index >= 0:
-      # label belongs to a target, return parent package label
-      return label[:package_label_index]
-
-    # label belongs to a container, its parent is either top-level package,
-    # repository or the global root node
-    package_label_index = label.rfind("/")
-
-    if package_label_index < 0:
-      # label belongs to a global root, as it is the only one without slashes
-      # in it
+    parent_label: Optional[str] = Label.parse(label).parent
+    if parent_label is None:
       raise LookupError("Root node cannonot have a parrent")
-
-    if self.label.endswith("//"):
-      # label belongs to a repository, return global root label
-      return "@" if label.startswith("@") else ""
-
-    if label[package_label_index - 1] == "/":
-      # label is the top most package in a repo, return the repo
-      return label[:package_label_index + 1]
-
-    # label is a nested package in a repo, return a parent package
-    return label[:package_label_index]
+    return parent_label
 
 
 class ContainerNode(Node):
+  __slots__ = ("children", "_label_index", "_containers",
+               "_containers_by_kind", "_targets", "_targets_by_kind",
+               "_targets_by_class", "_targets_by_name")
+
   @abstractmethod
   def __init__(self, kind: Rule, name: str, label: str) -> None:
     super().__init__(kind, name, label)
     self.children: Dict[str, Node] = {}
+    # Every node of the tree by its label, shared by all the containers of the
+    # tree. Children must be added and removed through the container methods
+    # to keep it up to date.
+    self._label_index: Dict[str, Node] = {label: self}
+    # Direct children by label, split by their kind, class and name, in the
+    # order of children. Kind of a node must not change while it is in a tree.
+    self._containers: Dict[str, ContainerNode] = {}
+    # Kind indexes are keyed by kind names, which hash faster than rules
+    self._containers_by_kind: Dict[str, Dict[str, ContainerNode]] = {}
+    self._targets: Dict[str, TargetNode] = {}
+    self._targets_by_kind: Dict[str, Dict[str, TargetNode]] = {}
+    self._targets_by_class: Dict[type, Dict[str, TargetNode]] = {}
+    self._targets_by_name: Dict[str, TargetNode] = {}
 
   # shallow search only
   def get_containers(self, kind: Optional[Rule] = None) -> Iterable[
     ContainerNode]:
-    for node in self.children.values():
-      if isinstance(node, ContainerNode) and (not kind or node.kind == kind):
-        yield cast(ContainerNode, node)
+    containers: Dict[str, ContainerNode] = self._containers if not kind else \
+      self._containers_by_kind.get(kind.kind, {})
+    return containers.values()
 
   # shallow search only
   def get_targets(self, kind: Optional[Rule] = None) -> Iterable[TargetNode]:
-    for node in self.children.values():
-      if isinstance(node, TargetNode) and (not kind or (node.kind == kind)):
-        yield cast(TargetNode, node)
+    targets: Dict[str, TargetNode] = self._targets if not kind else \
+      self._targets_by_kind.get(kind.kind, {})
+    return targets.values()
+
+  # shallow search only, subclasses of the node class are not included
+  def get_targets_of_class(self, node_class: type) -> Iterable[TargetNode]:
+    return self._targets_by_class.get(node_class, {}).values()
 
   # shalow search only
   def get_target(self, name) -> Optional[TargetNode]:
-    for label, node in self.children.items():
-      if isinstance(node, TargetNode) and node.name == name:
-        return node
-    return None
+    return self._targets_by_name.get(name)
 
   def __getitem__(self, label: str) -> Optional[Node]:
-    if not label.startswith(self.label):
+    node: Optional[Node] = self._label_index.get(label)
+    if node is None or not self._is_ancestor_of(label):
       return None
+    return node
 
-    child_start_index: int = len(self.label)
-    if len(label) == child_start_index:
-      return self
-
-    child_label_start_char: str = label[child_start_index]
-    if child_label_start_char == ":":
-      # It must be a target, so must be amoung direct children of this container
-      return self.children.get(label)
-
-    child_start_index += 1  # +1 is to skip '/' delimiter
-    next_package_index: int
-    next_target_index: int
-    if label[child_start_index] == "/":
-      # self is RootNode as its label ends before '//'
-      next_package_index = child_start_index + 1
-      next_target_index = -1
-    else:
-      next_package_index = label.find("/", child_start_index)
-      next_target_index = label.rfind(":", child_start_index)
-
-    next_label: str
-
-    if next_package_index < 0 and next_target_index < 0:
-      return self.children.get(label)
-    elif next_package_index < 0:
-      next_label = label[:next_target_index]
-    elif next_target_index < 0:
-      next_label = label[:next_package_index]
-    else:
-      next_label = label[:min(next_target_index, next_package_index)]
-
-    next_child: Optional[Node] = self.children.get(next_label)
-    if not next_child:
+  # Finds a node by walking the tree instead of using the label index, to
+  # check the index consistency only
+  def find_in_tree(self, label: str) -> Optional[Node]:
+    if not self._is_ancestor_of(label):
       return None
-
-    # It must be a container node, or this method would have terminated earlier
-    return cast(ContainerNode, next_child)[label]
+    if len(label) == len(self.label):
+      return self
+    child: Optional[Node] = self.children.get(label)
+    if child is not None:
+      return child
+    for child in self.children.values():
+      if isinstance(child, ContainerNode) and cast(ContainerNode,
+                                                   child)._is_ancestor_of(label):
+        return cast(ContainerNode, child).find_in_tree(label)
+    return None
 
   def __setitem__(self, label: str, child: Node) -> None:
     self._setitem(label, child)
@@ -158,6 +153,103 @@ class ContainerNode(Node):
   def __delitem__(self, label: str) -> None:
     self._setitem(label, None)
 
+  # Adds (or replaces) a direct child, along with its subtree if it is a
+  # container
+  def add_child(self, child: Node) -> None:
+    previous_child: Optional[Node] = self.children.get(child.label)
+    if previous_child is not None and previous_child is not child:
+      self.remove_child(previous_child.label)
+    label: str = child.label
+    self.children[label] = child
+    if isinstance(child, ContainerNode):
+      container_child: ContainerNode = cast(ContainerNode, child)
+      self._containers[label] = container_child
+      self._containers_by_kind.setdefault(child.kind.kind, {})[
+        label] = container_child
+      for node in container_child.tree_nodes():
+        self._label_index[node.label] = node
+        if isinstance(node, ContainerNode):
+          cast(ContainerNode, node)._label_index = self._label_index
+    else:
+      target_child: TargetNode = cast(TargetNode, child)
+      self._targets[label] = target_child
+      kind_targets: Optional[Dict[str, TargetNode]] = \
+        self._targets_by_kind.get(child.kind.kind)
+      if kind_targets is None:
+        kind_targets = self._targets_by_kind[child.kind.kind] = {}
+      kind_targets[label] = target_child
+      class_targets: Optional[Dict[str, TargetNode]] = \
+        self._targets_by_class.get(type(child))
+      if class_targets is None:
+        class_targets = self._targets_by_class[type(child)] = {}
+      class_targets[label] = target_child
+      self._targets_by_name[child.name] = target_child
+      self._label_index[label] = child
+
+  # Removes a direct child, along with its subtree if it is a container
+  def remove_child(self, label: str) -> None:
+    child: Node = self.children.pop(label)
+    if isinstance(child, ContainerNode):
+      del self._containers[label]
+      self._remove_from_group(self._containers_by_kind, child.kind.kind,
+                              label)
+      container_child: ContainerNode = cast(ContainerNode, child)
+      subtree_index: Dict[str, Node] = {}
+      for node in container_child.tree_nodes():
+        del self._label_index[node.label]
+        subtree_index[node.label] = node
+        if isinstance(node, ContainerNode):
+          cast(ContainerNode, node)._label_index = subtree_index
+    else:
+      del self._targets[label]
+      self._remove_from_group(self._targets_by_kind, child.kind.kind, label)
+      self._remove_from_group(self._targets_by_class, type(child), label)
+      del self._targets_by_name[child.name]
+      del self._label_index[label]
+
+  def _check_children_indexes(self) -> None:
+    containers: List[ContainerNode] = [cast(ContainerNode, n) for n in
+                                       self.children.values() if
+                                       isinstance(n, ContainerNode)]
+    targets: List[TargetNode] = [cast(TargetNode, n) for n in
+                                 self.children.values() if
+                                 isinstance(n, TargetNode)]
+    if list(self._containers.values()) != containers or \
+        list(self._targets.values()) != targets or \
+        any(self._containers_by_kind.get(c.kind.kind, {}).get(c.label) is not c
+            for c in containers) or \
+        sum(len(c) for c in self._containers_by_kind.values()) != len(
+        containers) or \
+        any(self._targets_by_kind.get(t.kind.kind, {}).get(t.label) is not t
+            for t in targets) or \
+        sum(len(t) for t in self._targets_by_kind.values()) != len(targets) or \
+        any(self._targets_by_class.get(type(t), {}).get(t.label) is not t for t
+            in targets) or \
+        sum(len(t) for t in self._targets_by_class.values()) != len(
+        targets) or \
+        any(self.get_target(t.name) is not t for t in targets) or \
+        len(self._targets_by_name) != len(targets):
+      raise LookupError(f"Children indexes do not match children: node = {self}")
+
+  def _remove_from_group(self, groups: Dict[Any, Dict[str, Any]], group: Any,
+      label: str) -> None:
+    nodes: Dict[str, Any] = groups[group]
+    del nodes[label]
+    if not nodes:
+      del groups[group]
+
+  # Raises LookupError if the label index (or the children indexes of the
+  # containers) does not match the subtree of this container
+  def check_label_index(self) -> None:
+    for node in self.tree_nodes():
+      if self[node.label] is not node:
+        raise LookupError(f"Node is not indexed: node = {node}")
+      if isinstance(node, ContainerNode):
+        cast(ContainerNode, node)._check_children_indexes()
+    for label, node in self._label_index.items():
+      if self._is_ancestor_of(label) and self.find_in_tree(label) is not node:
+        raise LookupError(f"Indexed node is not in the tree: node = {node}")
+
   def tree_nodes(self) -> Iterable[Node]:
     return self._tree_nodes_preorder(self)
 
@@ -185,12 +277,23 @@ class ContainerNode(Node):
 
     container_parent: ContainerNode = cast(ContainerNode, parent)
     if child:
-      container_parent.children[label] = child
+      container_parent.add_child(child)
     else:
-      del container_parent.children[label]
+      container_parent.remove_child(label)
+
+  # Labels of the subtree start with the container label, followed by a
+  # package or target separator, unless the label of the container ends with
+  # one (repositories and roots).
+  def _is_ancestor_of(self, label: str) -> bool:
+    if not label.startswith(self.label):
+      return False
+    if len(label) == len(self.label) or not self.label or self.label[-1] in "/@":
+      return True
+    return label[len(self.label)] in ":/"
 
 
 class RootNode(ContainerNode):
+  __slots__ = ()
   _RULE_KIND: Rule = Rule("__root__")
 
   def __init__(self, name: str) -> None:
@@ -198,6 +301,7 @@ class RootNode(ContainerNode):
 
 
 class RepositoryNode(ContainerNode):
+  __slots__ = ()
   _RULE_KIND: Rule = Rule("__repository__")
 
   def __init__(self, name: str, parent_label: str) -> None:
@@ -205,6 +309,7 @@ class RepositoryNode(ContainerNode):
 
 
 class PackageNode(ContainerNode):
+  __slots__ = ("functions",)
   _RULE_KIND: Rule = Rule("__package__")
 
   def __init__(self, name: str, parent_label: str, depth: int) -> None:
@@ -216,30 +321,166 @@ class PackageNode(ContainerNode):
     return cast(Iterable[PackageNode], self.get_containers())
 
   def get_package_folder_path(self) -> str:
-    return self.label.split("//", 1)[1]
+    return self.parsed_label.package
 
 
 class TargetNode(Node):
   _TARGET_STUB_KIND: Rule = Rule("__target_stub__")
+  # A placeholder is upgraded to a file node by changing its class, which
+  # requires the same layout, so subclasses must not add slots of their own.
+  # maternal_target is set for generated files only.
+  __slots__ = ("_value_args_loader", "_label_list_args", "_label_args",
+               "_string_list_args", "_string_args", "_bool_args", "_int_args",
+               "_str_str_map_args", "_out_label_list_args", "_out_label_args",
+               "_outputs", "generator_name", "generator_function",
+               "sort_labels", "maternal_target")
 
   def __init__(self, kind: Rule, name: str, parent_label: str) -> None:
     super().__init__(kind, name, f"{parent_label}:{name}")
 
-    self.label_list_args: Dict[str, List[TargetNode]] = {}
-    self.label_args: Dict[str, TargetNode] = {}
-    self.string_list_args: Dict[str, List[str]] = {}
-    self.string_args: Dict[str, str] = {}
-    self.bool_args: Dict[str, bool] = {}
-    self.int_args: Dict[str, int] = {}
-    self.str_str_map_args: Dict[str, Dict[str, str]] = {}
-    self.out_label_list_args: Dict[str, List[TargetNode]] = {}
-    self.out_label_args: Dict[str, TargetNode] = {}
-    self.outputs: List[TargetNode] = []
+    # Fills value (non-label) attributes on their first access, see
+    # defer_value_args()
+    self._value_args_loader: Optional[Callable[[TargetNode], None]] = None
+    # Most of the nodes are files with no attributes at all, so the attributes
+    # are allocated on their first access only
+    self._label_list_args: Optional[Dict[str, List[TargetNode]]] = None
+    self._label_args: Optional[Dict[str, TargetNode]] = None
+    self._string_list_args: Optional[Dict[str, List[str]]] = None
+    self._string_args: Optional[Dict[str, str]] = None
+    self._bool_args: Optional[Dict[str, bool]] = None
+    self._int_args: Optional[Dict[str, int]] = None
+    self._str_str_map_args: Optional[Dict[str, Dict[str, str]]] = None
+    self._out_label_list_args: Optional[Dict[str, List[TargetNode]]] = None
+    self._out_label_args: Optional[Dict[str, TargetNode]] = None
+    self._outputs: Optional[List[TargetNode]] = None
 
     self.generator_name: str = ""
     self.generator_function: str = ""
 
-    self.sort_labels = True
+    self.sort_labels: bool = True
+    self.maternal_target: Optional[TargetNode] = None
+
+  @property
+  def label_list_args(self) -> Dict[str, List[TargetNode]]:
+    if self._label_list_args is None:
+      self._label_list_args = {}
+    return self._label_list_args
+
+  @label_list_args.setter
+  def label_list_args(self, value: Dict[str, List[TargetNode]]) -> None:
+    self._label_list_args = value
+
+  @property
+  def label_args(self) -> Dict[str, TargetNode]:
+    if self._label_args is None:
+      self._label_args = {}
+    return self._label_args
+
+  @label_args.setter
+  def label_args(self, value: Dict[str, TargetNode]) -> None:
+    self._label_args = value
+
+  @property
+  def string_list_args(self) -> Dict[str, List[str]]:
+    self._load_value_args()
+    if self._string_list_args is None:
+      self._string_list_args = {}
+    return self._string_list_args
+
+  @string_list_args.setter
+  def string_list_args(self, value: Dict[str, List[str]]) -> None:
+    self._load_value_args()
+    self._string_list_args = value
+
+  @property
+  def string_args(self) -> Dict[str, str]:
+    self._load_value_args()
+    if self._string_args is None:
+      self._string_args = {}
+    return self._string_args
+
+  @string_args.setter
+  def string_args(self, value: Dict[str, str]) -> None:
+    self._load_value_args()
+    self._string_args = value
+
+  @property
+  def bool_args(self) -> Dict[str, bool]:
+    self._load_value_args()
+    if self._bool_args is None:
+      self._bool_args = {}
+    return self._bool_args
+
+  @bool_args.setter
+  def bool_args(self, value: Dict[str, bool]) -> None:
+    self._load_value_args()
+    self._bool_args = value
+
+  @property
+  def int_args(self) -> Dict[str, int]:
+    self._load_value_args()
+    if self._int_args is None:
+      self._int_args = {}
+    return self._int_args
+
+  @int_args.setter
+  def int_args(self, value: Dict[str, int]) -> None:
+    self._load_value_args()
+    self._int_args = value
+
+  @property
+  def str_str_map_args(self) -> Dict[str, Dict[str, str]]:
+    self._load_value_args()
+    if self._str_str_map_args is None:
+      self._str_str_map_args = {}
+    return self._str_str_map_args
+
+  @str_str_map_args.setter
+  def str_str_map_args(self, value: Dict[str, Dict[str, str]]) -> None:
+    self._load_value_args()
+    self._str_str_map_args = value
+
+  @property
+  def out_label_list_args(self) -> Dict[str, List[TargetNode]]:
+    if self._out_label_list_args is None:
+      self._out_label_list_args = {}
+    return self._out_label_list_args
+
+  @out_label_list_args.setter
+  def out_label_list_args(self, value: Dict[str, List[TargetNode]]) -> None:
+    self._out_label_list_args = value
+
+  @property
+  def out_label_args(self) -> Dict[str, TargetNode]:
+    if self._out_label_args is None:
+      self._out_label_args = {}
+    return self._out_label_args
+
+  @out_label_args.setter
+  def out_label_args(self, value: Dict[str, TargetNode]) -> None:
+    self._out_label_args = value
+
+  @property
+  def outputs(self) -> List[TargetNode]:
+    if self._outputs is None:
+      self._outputs = []
+    return self._outputs
+
+  @outputs.setter
+  def outputs(self, value: List[TargetNode]) -> None:
+    self._outputs = value
+
+  # Value attributes are needed only to print the target, which many targets
+  # never are, so their decoding may be deferred until the first access to
+  # any of them. The loader is called once with this node.
+  def defer_value_args(self, loader: Callable[[TargetNode], None]) -> None:
+    self._value_args_loader = loader
+
+  def _load_value_args(self) -> None:
+    if self._value_args_loader is not None:
+      loader: Callable[[TargetNode], None] = self._value_args_loader
+      self._value_args_loader = None
+      loader(self)
 
   def duplicate(self, kind: Optional[Rule], name: Optional[str],
       parent_label: Optional[str]) -> TargetNode:
@@ -299,23 +540,27 @@ class TargetNode(Node):
 
   @staticmethod
   def create_stub(label: str) -> TargetNode:
-    pkg_and_name: List[str] = label.split(":")
-    return TargetNode(TargetNode._TARGET_STUB_KIND, pkg_and_name[1],
-                      pkg_and_name[0])
+    package_label: str
+    name: str
+    package_label, _, name = label.rpartition(":")
+    return TargetNode(TargetNode._TARGET_STUB_KIND, name, package_label)
 
   def get_targets(self, kind: Optional[Rule] = None) -> Iterable[TargetNode]:
-    # targets: Dict[str, TargetNode] = {}
-    for label_list_arg in self.label_list_args.values():
-      for label_list_node in label_list_arg:
-        if not kind or label_list_node.kind == kind:
-          yield label_list_node
+    # Read without allocating the attributes of the nodes which have none
+    if self._label_list_args:
+      for label_list_arg in self._label_list_args.values():
+        for label_list_node in label_list_arg:
+          if not kind or label_list_node.kind == kind:
+            yield label_list_node
 
-    for label_arg in self.label_args.values():
-      if not kind or label_arg.kind == kind:
-        yield label_arg
+    if self._label_args:
+      for label_arg in self._label_args.values():
+        if not kind or label_arg.kind == kind:
+          yield label_arg
 
 
 class FileNode(TargetNode):
+  __slots__ = ()
   SOURCE_FILE_KIND: Rule = Rule("source")
 
   def __init__(self, name: str, parent_label: str) -> None:
@@ -323,15 +568,81 @@ class FileNode(TargetNode):
 
 
 class GeneratedFileNode(TargetNode):
+  __slots__ = ()
   GENERATED_FILE_KIND: Rule = BuiltInRules.rules()["generated"]
 
   def __init__(self, name: str, parent_label: str,
       maternal_target: TargetNode) -> None:
     super().__init__(GeneratedFileNode.GENERATED_FILE_KIND, name, parent_label)
-    self.maternal_target: TargetNode = maternal_target
+    self.maternal_target = maternal_target
 
   @staticmethod
   def create_gen_file(label: str,
       maternal_target: TargetNode) -> GeneratedFileNode:
-    pkg_and_name = label.split(":")
-    return GeneratedFileNode(pkg_and_name[1], pkg_and_name[0], maternal_target)
+    package_label: str
+    name: str
+    package_label, _, name = label.rpartition(":")
+    return GeneratedFileNode(name, package_label, maternal_target)
+
+
+# Single canonical node per label. A referenced label gets a stub node as a
+# placeholder, which is upgraded in place (kind and, for files, class) once the
+# label is defined, so every reference sees the definition without resolving
+# references afterwards.
+class LabelRegistry:
+  def __init__(self) -> None:
+    self._nodes: Dict[str, TargetNode] = {}
+    # Guards upgrades of placeholders, so a label is defined only once even if
+    # outputs are parsed concurrently
+    self._lock: threading.Lock = threading.Lock()
+
+  def reference(self, label: str) -> TargetNode:
+    node: Optional[TargetNode] = self._nodes.get(label)
+    if node is None:
+      node = self._nodes.setdefault(label, TargetNode.create_stub(label))
+    return node
+
+  def is_defined(self, label: str) -> bool:
+    node: Optional[TargetNode] = self._nodes.get(label)
+    return node is not None and not node.is_stub()
+
+  # Returns None if the label is defined already
+  def define_target(self, kind: Rule, label: str) -> Optional[TargetNode]:
+    with self._lock:
+      node: Optional[TargetNode] = self._placeholder(label)
+      if node is not None:
+        node.kind = kind
+    return node
+
+  # Returns None if the label is defined already
+  def define_generated_file(self, label: str,
+      maternal_target: TargetNode) -> Optional[GeneratedFileNode]:
+    with self._lock:
+      node: Optional[TargetNode] = self._placeholder(label)
+      if node is None:
+        return None
+      node.__class__ = GeneratedFileNode
+      node.kind = GeneratedFileNode.GENERATED_FILE_KIND
+      gen_file_node: GeneratedFileNode = cast(GeneratedFileNode, node)
+      gen_file_node.maternal_target = maternal_target
+    return gen_file_node
+
+  # Source files are defined only if they are referenced, returns None for the
+  # labels which are not referenced or are defined already.
+  def define_source_file(self, label: str) -> Optional[FileNode]:
+    with self._lock:
+      node: Optional[TargetNode] = self._nodes.get(label)
+      if node is None or not node.is_stub():
+        return None
+      node.__class__ = FileNode
+      node.kind = FileNode.SOURCE_FILE_KIND
+    return cast(FileNode, node)
+
+  # Referenced, but not yet defined labels
+  def placeholders(self) -> List[TargetNode]:
+    with self._lock:
+      return [n for n in self._nodes.values() if n.is_stub()]
+
+  def _placeholder(self, label: str) -> Optional[TargetNode]:
+    node: TargetNode = self.reference(label)
+    return node if node.is_stub() else None
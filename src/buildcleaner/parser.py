@@ -1,314 +1,455 @@
+import hashlib
 import re
+import threading
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from functools import partial
 from itertools import chain
+from typing import Any
 from typing import Callable
+from typing import Container
+from typing import Deque
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
-from typing import Match
 from typing import Optional
 from typing import Pattern
 from typing import Set
 from typing import Tuple
 
-from buildcleaner.node import FileNode
-from buildcleaner.node import GeneratedFileNode
+from buildcleaner.build_output import BuildOutputDecoder
+from buildcleaner.build_output import decode_build_blocks_shard
+from buildcleaner.cache import PackageParseCache
+from buildcleaner.label import Label
+from buildcleaner.node import LabelRegistry
 from buildcleaner.node import TargetNode
+from buildcleaner.proto import QueryRule
+from buildcleaner.proto import decode_jsonproto_output
+from buildcleaner.proto import decode_streamed_proto_message
 from buildcleaner.rule import Rule
 
 
 class BazelBuildTargetsParser:
+  # Number of build output blocks sent to a worker process at once by parallel
+  # parsing
+  _PARSE_SHARD_SIZE: int = 1000
+
   def __init__(self, path_prefix: str, rules_to_parse: Dict[str, Rule],
-      rules_to_ignore: Dict[str, Rule]) -> None:
+      rules_to_ignore: Dict[str, Rule],
+      label_registry: Optional[LabelRegistry] = None,
+      lazy_attrs: bool = False,
+      package_cache: Optional[PackageParseCache] = None) -> None:
+    if lazy_attrs and package_cache:
+      # Lazily decoded targets have no complete attributes to cache
+      raise ValueError("Package cache does not support lazy attributes")
     self._rules_to_parse: Dict[str, Rule] = rules_to_parse.copy()
     self._rules_to_ignore: Dict[str, Rule] = rules_to_ignore.copy()
+    # Number of targets of each unknown (neither parsed nor ignored) rule kind
+    # met in all the outputs parsed so far
+    self._unknown_rule_kinds: Dict[str, int] = {}
+    # Number of targets rejected for each reason (external or incompatible)
+    self._rejected_targets: Dict[str, int] = {}
+    self._counters_lock: threading.Lock = threading.Lock()
     self._target_splitter_regex: Pattern = re.compile(r"(?:\r?\n){2,}")
-    self._package_name_regex: Pattern = re.compile(
-        fr"#\s*{path_prefix}/(?P<value>[0-9a-zA-Z\-\._\@/]+)/BUILD(.bazel)?:")
-    self._label_kind_regex: Pattern = re.compile(
-        r"\s*(?P<kind>[\w]+)\s*\w*\s+(?P<package>@?//.*):(?P<name>.*)\s+\(")
-
-    self._arg_label_list_regex: Dict[str, Pattern] = {}
-    self._arg_label_regex: Dict[str, Pattern] = {}
-    self._arg_string_list_regex: Dict[str, Pattern] = {}
-    self._arg_string_regex: Dict[str, Pattern] = {}
-
-    for build_in_arg in ["name", "generator_name", "generator_function"]:
-      self._arg_string_regex[build_in_arg] = re.compile(
-          fr"\b{build_in_arg}\b\s*=\s*\"(?P<value>[0-9a-zA-Z\-\._\+/]+)\"")
-
-    self._arg_bool_regex: Dict[str, Pattern] = {}
-    self._arg_int_regex: Dict[str, Pattern] = {}
-    self._arg_str_str_map_regex: Dict[str, Pattern] = {}
-
-    self._arg_out_label_list_regex: Dict[str, Pattern] = {}
-    self._arg_out_label_regex: Dict[str, Pattern] = {}
-
-    self._rule_parsers: List[
-      Tuple[Pattern, Callable[[str], Optional[TargetNode]]]] = []
-    self._ignored_rule_parsers: List[
-      Tuple[Pattern, Callable[[str], Optional[TargetNode]]]] = []
-
-    for rule in rules_to_parse.values():
-      self._init_args_parsers(rule)
-      self._rule_parsers.append(self._rule_parser(rule))
-
-    for rule in rules_to_ignore.values():
-      self._init_args_parsers(rule)
-      self._ignored_rule_parsers.append(self._rule_parser(rule))
-
-  def _init_args_parsers(self, rule: Rule) -> None:
-    for arg in rule.label_list_args:
-      self._arg_label_list_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*\[(?P<values>.*)\][,\s]*\n")
-    for arg in rule.label_args:
-      self._arg_label_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*\"(?P<value>.*)\"")
-    for arg in rule.string_list_args:
-      self._arg_string_list_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*\[(?P<values>.*)\][,\s]*\n")
-    for arg in rule.string_args:
-      self._arg_string_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*\"(?P<value>.*)\"")
-    for arg in rule.bool_args:
-      self._arg_bool_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*(?P<value>\w+)")
-    for arg in rule.int_args:
-      self._arg_int_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*(?P<value>\d+)")
-    for arg in rule.str_str_map_args:
-      self._arg_str_str_map_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*\{{(?P<values>.+)\}}[,\s]*\n")
-
-    for arg in rule.out_label_list_args:
-      self._arg_out_label_list_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*\[(?P<values>.+)\][,\s]*\n")
-    for arg in rule.out_label_args:
-      self._arg_out_label_regex[arg] = re.compile(
-          fr"\b{arg}\b\s*=\s*\"(?P<value>.*)\"")
-
-  def parse_query_build_output(self, query_build_output: str) -> Tuple[
+
+    # In lazy mode value attributes of build output targets are decoded on
+    # their first access
+    self._build_output_decoder: BuildOutputDecoder = BuildOutputDecoder(
+        path_prefix, rules_to_parse, rules_to_ignore, lazy_attrs)
+    # Nodes of parsed rules and of the labels they reference, shared by all the
+    # outputs parsed
+    self._label_registry: LabelRegistry = label_registry \
+      if label_registry else LabelRegistry()
+    # Decoded build output targets of unchanged packages
+    self._package_cache: Optional[PackageParseCache] = package_cache
+    # Labels of the build output blocks parsed so far by the digests of the
+    # blocks, an identical block met again is not decoded at all. Built-in
+    # hash() may collide, a collision would silently reuse a wrong node.
+    self._parsed_blocks: Dict[bytes, str] = {}
+
+  # Labels of rule targets which are present in the output, but are not turned
+  # into nodes (ignored, unknown or incompatible rules) are added to
+  # skipped_labels, if provided. Blocks of known_labels, and blocks identical to
+  # the ones parsed into nodes before, are not parsed at all, their labels are
+  # added to reused_labels instead. If ambiguous_labels is
+  # provided, the output is expected to come from bazel query: rules with
+  # unresolved select() are not parsed, their labels are added to
+  # ambiguous_labels. With process_pool, blocks are decoded by the worker
+  # processes of the pool, nodes are still built by the calling thread.
+  def parse_query_build_output(self, query_build_output: str,
+      skipped_labels: Optional[Set[str]] = None,
+      known_labels: Optional[Container[str]] = None,
+      reused_labels: Optional[Set[str]] = None,
+      ambiguous_labels: Optional[Set[str]] = None,
+      process_pool: Optional[Executor] = None) -> Tuple[
+    Dict[str, TargetNode], Set[str], Set[str]]:
+    return self.parse_query_build_blocks(
+        self._target_splitter_regex.split(query_build_output.strip()),
+        skipped_labels, known_labels, reused_labels, ambiguous_labels,
+        process_pool)
+
+  def parse_query_build_blocks(self, target_rules: Iterable[str],
+      skipped_labels: Optional[Set[str]] = None,
+      known_labels: Optional[Container[str]] = None,
+      reused_labels: Optional[Set[str]] = None,
+      ambiguous_labels: Optional[Set[str]] = None,
+      process_pool: Optional[Executor] = None) -> Tuple[
+    Dict[str, TargetNode], Set[str], Set[str]]:
+    query_rules: Iterator[QueryRule] = self._decode_build_blocks(
+        self._skip_parsed_blocks(target_rules, reused_labels), known_labels,
+        ambiguous_labels, process_pool)
+    parsed: Tuple[Dict[str, TargetNode], Set[str], Set[str]] = \
+      self._parse_query_rules(query_rules, skipped_labels, known_labels,
+                              reused_labels, escaped_values=True)
+    if self._package_cache:
+      self._package_cache.flush()
+    return parsed
+
+  def _decode_build_blocks(self, target_rules: Iterable[str],
+      known_labels: Optional[Container[str]],
+      ambiguous_labels: Optional[Set[str]],
+      process_pool: Optional[Executor]) -> Iterator[QueryRule]:
+    decoded_rules: Iterable[Tuple[str, Optional[QueryRule]]]
+    if process_pool is None:
+      decoded_rules = ((t, self._decode_build_block(t)) for t in target_rules)
+    else:
+      decoded_rules = self._decode_build_blocks_in_pool(target_rules,
+                                                        process_pool)
+    for target_rule, query_rule in decoded_rules:
+      if not query_rule:
+        continue
+      if query_rule.label and not query_rule.rejected:
+        self._parsed_blocks[BazelBuildTargetsParser._block_digest(
+            target_rule)] = query_rule.label
+      # Values of configurable attributes depend on configuration, which
+      # query knows nothing about. A select() inside of a string value makes
+      # the block ambiguous too, it only costs an extra cquery.
+      if ambiguous_labels is not None and not query_rule.rejected and \
+          "select(" in target_rule and not (
+          known_labels and query_rule.label in known_labels):
+        ambiguous_labels.add(query_rule.label)
+        continue
+      yield query_rule
+
+  # Text of a block determines its node completely, so the node of a block
+  # parsed before is reused as is, without decoding the block again.
+  def _skip_parsed_blocks(self, target_rules: Iterable[str],
+      reused_labels: Optional[Set[str]]) -> Iterator[str]:
+    for target_rule in target_rules:
+      label: Optional[str] = self._parsed_blocks.get(
+          BazelBuildTargetsParser._block_digest(target_rule))
+      if label is None or not self._label_registry.is_defined(label):
+        yield target_rule
+      elif reused_labels is not None:
+        reused_labels.add(label)
+
+  @staticmethod
+  def _block_digest(target_rule: str) -> bytes:
+    return hashlib.sha1(target_rule.encode("utf-8")).digest()
+
+  def _decode_build_block(self, target_rule: str) -> Optional[QueryRule]:
+    if not target_rule:
+      return None
+    query_rule: Optional[QueryRule] = self._cached_build_block(target_rule)
+    if query_rule is None:
+      query_rule = self._build_output_decoder.decode_block(target_rule)
+      self._cache_build_block(query_rule)
+    return query_rule
+
+  def _cached_build_block(self, target_rule: str) -> Optional[QueryRule]:
+    if not self._package_cache:
+      return None
+    return self._package_cache.lookup(target_rule)
+
+  def _cache_build_block(self, query_rule: Optional[QueryRule]) -> None:
+    if self._package_cache and query_rule:
+      self._package_cache.add(query_rule)
+
+  # Blocks are sent to the pool in shards as soon as they arrive, results are
+  # taken in submission order, so nodes come out in the same order as with
+  # sequential decoding. Nodes of the finished shards are built while the
+  # workers decode the next ones. Cached blocks are not sent at all.
+  def _decode_build_blocks_in_pool(self, target_rules: Iterable[str],
+      process_pool: Executor) -> Iterator[Tuple[str, Optional[QueryRule]]]:
+    pending_shards: Deque[Tuple[List[str], List[Optional[QueryRule]], Future]] \
+      = deque()
+    shard: List[str] = []
+    for target_rule in target_rules:
+      shard.append(target_rule)
+      if len(shard) < BazelBuildTargetsParser._PARSE_SHARD_SIZE:
+        continue
+      pending_shards.append(self._submit_shard(shard, process_pool))
+      shard = []
+      while pending_shards and pending_shards[0][2].done():
+        yield from self._shard_results(*pending_shards.popleft())
+    if shard:
+      pending_shards.append(self._submit_shard(shard, process_pool))
+    while pending_shards:
+      yield from self._shard_results(*pending_shards.popleft())
+
+  def _submit_shard(self, shard: List[str], process_pool: Executor) -> Tuple[
+    List[str], List[Optional[QueryRule]], Future]:
+    cached_rules: List[Optional[QueryRule]] = [self._cached_build_block(t) for
+                                               t in shard]
+    uncached_shard: List[str] = [t for t, r in zip(shard, cached_rules) if
+                                 r is None]
+    return shard, cached_rules, process_pool.submit(
+        decode_build_blocks_shard, self._build_output_decoder, uncached_shard)
+
+  def _shard_results(self, shard: List[str],
+      cached_rules: List[Optional[QueryRule]], future: Future) -> Iterator[
+    Tuple[str, Optional[QueryRule]]]:
+    decoded_rules: Iterator[Optional[QueryRule]] = iter(future.result())
+    for target_rule, cached_rule in zip(shard, cached_rules):
+      query_rule: Optional[QueryRule] = cached_rule
+      if query_rule is None:
+        query_rule = next(decoded_rules)
+        self._cache_build_block(query_rule)
+      yield target_rule, query_rule
+
+  def parse_query_proto_messages(self, messages: Iterable[bytes],
+      skipped_labels: Optional[Set[str]] = None,
+      known_labels: Optional[Container[str]] = None,
+      reused_labels: Optional[Set[str]] = None) -> Tuple[
+    Dict[str, TargetNode], Set[str], Set[str]]:
+    query_rules: Iterator[Optional[QueryRule]] = (
+        decode_streamed_proto_message(m) for m in messages)
+    return self._parse_query_rules((r for r in query_rules if r),
+                                   skipped_labels, known_labels, reused_labels)
+
+  def parse_query_jsonproto_output(self, query_jsonproto_output: str,
+      skipped_labels: Optional[Set[str]] = None,
+      known_labels: Optional[Container[str]] = None,
+      reused_labels: Optional[Set[str]] = None) -> Tuple[
+    Dict[str, TargetNode], Set[str], Set[str]]:
+    return self._parse_query_rules(
+        decode_jsonproto_output(query_jsonproto_output), skipped_labels,
+        known_labels, reused_labels)
+
+  # Values of escaped_values rules are in escaped form already (as in build
+  # output), otherwise they are escaped here.
+  def _parse_query_rules(self, query_rules: Iterable[QueryRule],
+      skipped_labels: Optional[Set[str]],
+      known_labels: Optional[Container[str]],
+      reused_labels: Optional[Set[str]], escaped_values: bool = False) -> Tuple[
     Dict[str, TargetNode], Set[str], Set[str]]:
-    target_rules = self._target_splitter_regex.split(query_build_output.strip())
     internal_targets: Set[str] = set()
     external_targets: Set[str] = set()
     internal_nodes: Dict[str, TargetNode] = {}
 
-    unknown_rules: List[str] = []
-
-    for target_rule in target_rules:
-      unknown_rule: bool = True
-      if not target_rule:
+    for query_rule in query_rules:
+      if known_labels and query_rule.label in known_labels:
+        if reused_labels is not None:
+          reused_labels.add(query_rule.label)
         continue
-      for rule_parser in self._rule_parsers:
-        if rule_parser[0].search(target_rule):
-          unknown_rule = False
-          node = rule_parser[1](target_rule)
-          if not node:
-            continue
-          internal_nodes[str(node)] = node
-          # Put out nodes to list of all nodes so dependency on them can be
-          # properly resolved
-          for out_nodes in node.out_label_list_args.values():
-            for out_node in out_nodes:
-              internal_nodes[str(out_node)] = out_node
-          for out_node in chain(node.out_label_args.values(), node.outputs):
-            internal_nodes[str(out_node)] = out_node
-          internal_targets.add(node.label)
-
-          for targets in chain(node.label_list_args.values(),
-                               node.out_label_list_args.values()):
-            for t in targets:
-              if t.label[0] == "@":
-                external_targets.add(t.label)
-              else:
-                internal_targets.add(t.label)
-          for t in chain(node.label_args.values(),
-                         node.out_label_args.values(),
-                         node.outputs):
-            if t.label[0] == "@":
-              external_targets.add(t.label)
-            else:
-              internal_targets.add(t.label)
-          break
-      if unknown_rule:
-        for rule_parser in self._ignored_rule_parsers:
-          if rule_parser[0].search(target_rule):
-            # Found a known rule that should be ignored
-            unknown_rule = False
-            break
-      if unknown_rule:
-        unknown_rules.append(target_rule)
-        # Trully unknown rule. Either parse it or add to list of uknown ones
-        # raise ValueError(f"Unknown Rule: {target_rule}")
-
-    return internal_nodes, external_targets, internal_targets
-
-  def _rule_parser(self, rule: Rule) -> Tuple[
-    Pattern, Callable[[str], Optional[TargetNode]]]:
-
-    def args_parser_cosure(target_rule: str) -> Optional[TargetNode]:
+      # External and incompatible targets are rejected whatever their kind is.
+      # Decoders reject them early where it is cheap (build output).
+      rejected: str = query_rule.rejected or self._rejection_reason(
+          query_rule)
+      if rejected:
+        self._add_rejected_target(rejected)
+        # Skipped labels are excluded from the next queries
+        if skipped_labels is not None and query_rule.label:
+          self._add_skipped_target(query_rule, skipped_labels)
+        continue
+      # Ignored and unknown rules are skipped
+      rule: Optional[Rule] = self._rules_to_parse.get(query_rule.kind)
       node: Optional[TargetNode] = None
+      if rule:
+        node = self._query_rule_node(rule, query_rule, escaped_values)
+      elif query_rule.kind not in self._rules_to_ignore:
+        self._add_unknown_rule_kind(query_rule.kind)
+      if node:
+        self._add_node(node, internal_nodes, external_targets,
+                       internal_targets)
+      elif self._label_registry.is_defined(query_rule.label):
+        # Parsed from another output, e.g. of an overlapping chunk
+        continue
+      elif skipped_labels is not None:
+        self._add_skipped_target(query_rule, skipped_labels)
 
-      rule_name: Optional[Match[str]] = self._arg_string_regex["name"].search(
-          target_rule)
-      if not rule_name:
-        return node
-
-      rule_pkg: Optional[Match[str]] = self._package_name_regex.search(
-          target_rule)
+    return internal_nodes, external_targets, internal_targets
 
-      if not rule_pkg:
-        if rule.kind == "bind":
-          node = TargetNode(rule, rule_name.group('value'), f"//external")
+  # Outputs of a skipped target are skipped too: they are generated files
+  # without a node, not source files.
+  def _add_skipped_target(self, query_rule: QueryRule,
+      skipped_labels: Set[str]) -> None:
+    skipped_labels.add(query_rule.label)
+    package_label: str = Label.parse(query_rule.label).package_label
+    for output_attr in ("out", "outs"):
+      outputs: Any = query_rule.attributes.get(output_attr)
+      for output in outputs if isinstance(outputs, list) else [outputs]:
+        if output and isinstance(output, str):
+          skipped_labels.add(
+              output if ":" in output else f"{package_label}:{output}")
+
+  def get_label_registry(self) -> LabelRegistry:
+    return self._label_registry
+
+  # Unknown rule kinds with the number of their targets, most frequent first
+  def get_unknown_rule_kinds(self) -> List[Tuple[str, int]]:
+    with self._counters_lock:
+      return sorted(self._unknown_rule_kinds.items(), key=lambda x: -x[1])
+
+  def _add_unknown_rule_kind(self, kind: str) -> None:
+    with self._counters_lock:
+      self._unknown_rule_kinds[kind] = self._unknown_rule_kinds.get(kind, 0) + 1
+
+  # Number of rejected targets for each reason, most frequent first
+  def get_rejected_targets(self) -> List[Tuple[str, int]]:
+    with self._counters_lock:
+      return sorted(self._rejected_targets.items(), key=lambda x: -x[1])
+
+  def _add_rejected_target(self, reason: str) -> None:
+    with self._counters_lock:
+      self._rejected_targets[reason] = self._rejected_targets.get(reason, 0) + 1
+
+  def _query_rule_node(self, rule: Rule, query_rule: QueryRule,
+      escaped_values: bool) -> Optional[TargetNode]:
+    node: Optional[TargetNode] = self._label_registry.define_target(
+        rule, query_rule.label)
+    if node is None:
+      return None
+
+    # The rest of the tool keeps strings the way they are written in BUILD
+    # files (as in build output). Values of a wrong type are skipped.
+    escape: Callable[[str], str] = self._keep_value if escaped_values \
+      else self._escape_value
+    attrs: Dict[str, Any] = query_rule.attributes
+    if isinstance(attrs.get("generator_name"), str):
+      node.generator_name = attrs["generator_name"]
+    if isinstance(attrs.get("generator_function"), str):
+      node.generator_function = attrs["generator_function"]
+
+    for label_list_arg in rule.label_list_args:
+      if isinstance(attrs.get(label_list_arg), list):
+        node.label_list_args[label_list_arg] = [
+            self._label_registry.reference(t) for t in attrs[label_list_arg]]
+    for label_arg in rule.label_args:
+      if attrs.get(label_arg) and isinstance(attrs[label_arg], str):
+        node.label_args[label_arg] = self._label_registry.reference(
+            attrs[label_arg])
+    for out_label_list_arg in rule.out_label_list_args:
+      if attrs.get(out_label_list_arg) and isinstance(
+          attrs[out_label_list_arg], list):
+        node.out_label_list_args[out_label_list_arg] = [
+            self._gen_file_node(t, node) for t in attrs[out_label_list_arg]]
+    for out_label_arg in rule.out_label_args:
+      if attrs.get(out_label_arg) and isinstance(attrs[out_label_arg], str):
+        node.out_label_args[out_label_arg] = self._gen_file_node(
+            attrs[out_label_arg], node)
+    self._add_rule_outputs(rule, node)
+
+    if query_rule.raw_block:
+      node.defer_value_args(
+          partial(self._load_value_args, rule, query_rule.raw_block))
+    else:
+      self._set_value_args(node, rule, attrs, escape)
+
+    return node
+
+  def _load_value_args(self, rule: Rule, raw_block: str,
+      node: TargetNode) -> None:
+    self._set_value_args(
+        node, rule, self._build_output_decoder.decode_block_attributes(
+            raw_block), self._keep_value)
+
+  def _set_value_args(self, node: TargetNode, rule: Rule, attrs: Dict[str, Any],
+      escape: Callable[[str], str]) -> None:
+    for string_list_arg in rule.string_list_args:
+      if isinstance(attrs.get(string_list_arg), list):
+        node.string_list_args[string_list_arg] = [escape(v) for v in
+                                                  attrs[string_list_arg]]
+    for string_arg in rule.string_args:
+      if isinstance(attrs.get(string_arg), str):
+        node.string_args[string_arg] = escape(attrs[string_arg])
+    for bool_arg in rule.bool_args:
+      if isinstance(attrs.get(bool_arg), int):
+        node.bool_args[bool_arg] = bool(attrs[bool_arg])
+    for int_arg in rule.int_args:
+      if isinstance(attrs.get(int_arg), int):
+        node.int_args[int_arg] = int(attrs[int_arg])
+    for str_str_map_arg in rule.str_str_map_args:
+      if attrs.get(str_str_map_arg) and isinstance(attrs[str_str_map_arg],
+                                                   dict):
+        node.str_str_map_args[str_str_map_arg] = {
+            escape(k): escape(v) for k, v in attrs[str_str_map_arg].items()}
+
+  def _gen_file_node(self, label: str, maternal_target: TargetNode) -> \
+      TargetNode:
+    gen_file_node: Optional[TargetNode] = \
+      self._label_registry.define_generated_file(label, maternal_target)
+    return gen_file_node if gen_file_node else self._label_registry.reference(
+        label)
+
+  def _escape_value(self, value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n").replace("\t", "\\t")
+
+  def _keep_value(self, value: str) -> str:
+    return value
+
+  def _add_rule_outputs(self, rule: Rule, node: TargetNode) -> None:
+    for output_value in rule.outputs:
+      t = f"{node.get_parent_label()}:{output_value.format(node.name)}"
+      t_node = self._gen_file_node(t, node)
+      node.outputs.append(t_node)
+
+  def _rejection_reason(self, query_rule: QueryRule) -> str:
+    if query_rule.label.startswith("@"):
+      return QueryRule.EXTERNAL
+    if self._is_incompatible(query_rule.attributes):
+      return QueryRule.INCOMPATIBLE
+    return ""
+
+  # Checked on the attributes before the node is defined, so references to
+  # incompatible targets stay unresolved.
+  def _is_incompatible(self, attrs: Dict[str, Any]) -> bool:
+    target_compatible_with: Any = attrs.get("target_compatible_with")
+    return isinstance(target_compatible_with, list) and len(
+        target_compatible_with) == 1 and target_compatible_with[
+      0] == "@platforms//:incompatible"
+
+  def _add_node(self, node: TargetNode, internal_nodes: Dict[str, TargetNode],
+      external_targets: Set[str], internal_targets: Set[str]) -> None:
+    internal_nodes[str(node)] = node
+    # Put out nodes to list of all nodes so dependency on them can be
+    # properly resolved
+    for out_nodes in node.out_label_list_args.values():
+      for out_node in out_nodes:
+        internal_nodes[str(out_node)] = out_node
+    for out_node in chain(node.out_label_args.values(), node.outputs):
+      internal_nodes[str(out_node)] = out_node
+    internal_targets.add(node.label)
+
+    for targets in chain(node.label_list_args.values(),
+                         node.out_label_list_args.values()):
+      for t in targets:
+        if t.label[0] == "@":
+          external_targets.add(t.label)
         else:
-          # Must be an external node
-          return node
+          internal_targets.add(t.label)
+    for t in chain(node.label_args.values(),
+                   node.out_label_args.values(),
+                   node.outputs):
+      if t.label[0] == "@":
+        external_targets.add(t.label)
       else:
-        node = TargetNode(rule, rule_name.group("value"),
-                          f"//{rule_pkg.group('value')}")
-
-      generator_name: Optional[Match[str]] = self._arg_string_regex[
-        "generator_name"].search(target_rule)
-      if generator_name:
-        node.generator_name = generator_name.group("value")
-      generator_function: Optional[Match[str]] = self._arg_string_regex[
-        "generator_function"].search(target_rule)
-      if generator_function:
-        node.generator_function = generator_function.group("value")
-      t: str
-      match: Optional[Match[str]]
-      values: Optional[str]
-      t_node: TargetNode
-      for label_list_arg in rule.label_list_args:
-        match = self._arg_label_list_regex[label_list_arg].search(target_rule)
-        if match:
-          values = match.group("values")
-          node.label_list_args.setdefault(label_list_arg, [])
-          if values:
-            for arg_value in values.split(", "):
-              t = self._normalize_value(arg_value)
-              t_node = TargetNode.create_stub(t)
-              node.label_list_args[label_list_arg].append(t_node)
-
-      for label_arg in rule.label_args:
-        match = self._arg_label_regex[label_arg].search(target_rule)
-        if match:
-          t = self._normalize_value(match.group("value"))
-          t_node = TargetNode.create_stub(t)
-          node.label_args[label_arg] = t_node
-
-      for string_list_arg in rule.string_list_args:
-        match = self._arg_string_list_regex[string_list_arg].search(target_rule)
-        if match:
-          values = match.group("values")
-          node.string_list_args.setdefault(string_list_arg, [])
-          if values:
-            for arg_value in values.split('", "'):
-              t = self._normalize_value(arg_value)
-              node.string_list_args[string_list_arg].append(t)
-
-      for string_arg in rule.string_args:
-        match = self._arg_string_regex[string_arg].search(target_rule)
-        if match:
-          t = self._normalize_value(match.group("value"))
-          node.string_args[string_arg] = t
-
-      for bool_arg in rule.bool_args:
-        match = self._arg_bool_regex[bool_arg].search(target_rule)
-        if match:
-          t = self._normalize_value(match.group("value"))
-          node.bool_args[bool_arg] = t == "True" or t == "1"
-
-      for int_arg in rule.int_args:
-        match = self._arg_int_regex[int_arg].search(target_rule)
-        if match:
-          t = self._normalize_value(match.group("value"))
-          node.int_args[int_arg] = int(t)
-
-      for str_str_map_arg in rule.str_str_map_args:
-        match = self._arg_str_str_map_regex[str_str_map_arg].search(target_rule)
-        if match:
-          for arg_value in match.group("values").split('", "'):
-            arg_k_v: List[str] = arg_value.split(": ")
-            node.str_str_map_args.setdefault(str_str_map_arg, dict())[
-              self._normalize_value(arg_k_v[0])] = self._normalize_value(
-                arg_k_v[1])
-
-      for out_label_list_arg in rule.out_label_list_args:
-        match = self._arg_out_label_list_regex[out_label_list_arg].search(
-            target_rule)
-        if match:
-          for arg_value in match.group("values").split(", "):
-            t = self._normalize_value(arg_value)
-            t_node = GeneratedFileNode.create_gen_file(t, node)
-            node.out_label_list_args.setdefault(out_label_list_arg, []).append(
-                t_node)
-
-      for out_label_arg in rule.out_label_args:
-        match = self._arg_out_label_regex[out_label_arg].search(target_rule)
-        if match:
-          t = self._normalize_value(match.group("value"))
-          t_node = GeneratedFileNode.create_gen_file(t, node)
-          node.out_label_args[out_label_arg] = t_node
-
-      for output_value in rule.outputs:
-        t = f"{node.get_parent_label()}:{output_value.format(node.name)}"
-        t_node = GeneratedFileNode.create_gen_file(t, node)
-        node.outputs.append(t_node)
-
-      if "target_compatible_with" in node.label_list_args:
-        target_compatible_with: List[TargetNode] = node.label_list_args[
-          "target_compatible_with"]
-        if len(target_compatible_with) == 1 and target_compatible_with[
-          0].label == "@platforms//:incompatible":
-          return None
-
-      return node
-
-    return re.compile(fr"^{rule.kind}\(", re.MULTILINE), args_parser_cosure
-
-  def _normalize_value(self, string: str) -> str:
-    # This is very fragile and does not accomodate many potential corner cases
-    # and escaped quotes in target itself, but it seems to be good enough on
-    # practice. Improve if ever needed.
-    v = string.strip()
-    if v and v[0] == '"':
-      v = v[1:]
-    if v and v[-1] == '"' and (len(v) < 2 or v[-2] != "\\"):
-      v = v[:-1]
-    return v
-
-  def parse_query_label_kind_output(self, query_label_kind_output: str) -> Dict[
-    str, Dict[str, TargetNode]]:
-    target_rules: List[str] = query_label_kind_output.splitlines()
-    internal_nodes: Dict[str, TargetNode] = {}
-    for target_rule in target_rules:
-      match = self._label_kind_regex.search(target_rule)
-      if not match:
+        internal_targets.add(t.label)
+
+  # Labels of source files of label_kind output, lines are split as "<kind>
+  # <rule or file> <label> [(<configuration>)]", other targets are skipped as
+  # soon as their kind is known. No nodes are built here, the label registry
+  # defines the source files which are actually referenced.
+  def parse_query_label_kind_lines(self, lines: Iterable[str]) -> Set[str]:
+    source_labels: Set[str] = set()
+    for line in lines:
+      kind, _, rest = line.partition(" ")
+      if kind != "source":
         continue
-      rule_kind: str = match.group("kind")
-      node: TargetNode
-      if rule_kind == "source":
-        node = FileNode(match.group("name"), match.group("package"))
-      else:
-        kind: Optional[Rule] = self._rules_to_parse.get(rule_kind)
-        if not kind:
-          if rule_kind not in self._rules_to_ignore:
-            raise ValueError(f"Unknown Rule: {target_rule}")
-          continue
-        node = TargetNode(kind, match.group("name"), match.group("package"))
-      internal_nodes[str(node)] = node
-
-    nodes_by_kind: Dict[str, Dict[str, TargetNode]] = {}
-    for v in internal_nodes.values():
-      nodes_by_kind.setdefault(v.kind.kind, dict())[str(v)] = v
-
-    nodes_by_kind_count: List[Tuple[str, Dict[str, TargetNode]]] = []
-    for k, dict_v in nodes_by_kind.items():
-      nodes_by_kind_count.append((k, dict_v))
-
-    nodes_by_kind_count.sort(key=lambda x: -len(x[1]))
-    nodes_by_kind.clear()
-    for n in nodes_by_kind_count:
-      nodes_by_kind[n[0]] = n[1]
-
-    return nodes_by_kind
+      label: str = rest.partition(" ")[2].partition(" ")[0]
+      if ":" in label:
+        source_labels.add(label)
+    return source_labels
@@ -10,6 +10,7 @@ from typing import Union
 from typing import cast
 
 from buildcleaner.graph import TargetDagBuilder
+from buildcleaner.label import Label
 from buildcleaner.node import ContainerNode
 from buildcleaner.node import FileNode
 from buildcleaner.node import Function
@@ -148,9 +149,7 @@ class BuildTargetsPrinter(Printer):
 
   def print_build_file(self, pkg_node: PackageNode) -> str:
     nodes: List[TargetNode] = []
-    for t in pkg_node.get_targets():
-      if type(t) == TargetNode:
-        nodes.append(t)
+    nodes.extend(pkg_node.get_targets_of_class(TargetNode))
     nodes.sort(key=self._comparator.targets_in_container_key)
 
     import_statements: Set[str] = set()
@@ -232,12 +231,11 @@ class BuildTargetsPrinter(Printer):
     list_args_block: str = ""
 
     label_list_args_s: Dict[str, List[str]] = {}
-    pkg_prefix: str = pkg_label + ":"
     for k, v_list in label_list_args.items():
-      label_list_args_s[k] = [self._shorten_label(pkg_prefix, v) for v in
+      label_list_args_s[k] = [self._shorten_label(pkg_label, v) for v in
                               v_list]
     for k, v_list in out_label_list_args.items():
-      label_list_args_s[k] = [self._shorten_label(pkg_prefix, v) for v in
+      label_list_args_s[k] = [self._shorten_label(pkg_label, v) for v in
                               v_list]
 
     label_block: str = self._print_list_args_internal(label_list_args_s,
@@ -288,11 +286,10 @@ class BuildTargetsPrinter(Printer):
       string_args: Dict[str, str],
       out_label_args: Dict[str, TargetNode]) -> str:
     string_args_block: str = ""
-    pkg_prefix: str = pkg_label + ":"
-    label_args_s: Dict[str, str] = {k: self._shorten_label(pkg_prefix, v)
+    label_args_s: Dict[str, str] = {k: self._shorten_label(pkg_label, v)
                                     for k, v in
                                     label_args.items()}
-    out_label_args_s: Dict[str, str] = {k: self._shorten_label(pkg_prefix, v)
+    out_label_args_s: Dict[str, str] = {k: self._shorten_label(pkg_label, v)
                                         for k, v in
                                         out_label_args.items()}
     for string_args in [label_args_s, out_label_args_s, string_args]:
@@ -322,13 +319,11 @@ class BuildTargetsPrinter(Printer):
 
     return primitive_args_block
 
-  def _shorten_label(self, pkg_prefix: str, target: TargetNode):
-    label = str(target)
-    if label.startswith(pkg_prefix):
-      prefix_len = len(pkg_prefix) if isinstance(target, FileNode) else len(
-          pkg_prefix) - 1
-      return label[prefix_len:]
-    return label
+  def _shorten_label(self, pkg_label: str, target: TargetNode) -> str:
+    label: Label = target.parsed_label
+    if label.package_label != pkg_label or not label.is_target():
+      return label.label
+    return label.name if isinstance(target, FileNode) else f":{label.name}"
 
 
 class BuildFilesPrinter(BuildTargetsPrinter):
@@ -0,0 +1,239 @@
+import json
+from typing import Any
+from typing import Dict
+from typing import IO
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+# Minimal decoder of bazel query protobuf output (src/main/protobuf/build.proto
+# and analysis_v2.proto in bazel repository). Only the fields needed to build
+# the targets graph are decoded, everything else is skipped, so there is no
+# dependency on protobuf runtime or generated code.
+
+_VARINT: int = 0
+_FIXED64: int = 1
+_LENGTH_DELIMITED: int = 2
+_FIXED32: int = 5
+
+# blaze_query.Target.Discriminator
+_TARGET_TYPE_RULE: int = 1
+
+
+class QueryRule:
+  # Reasons to reject a target without building its node
+  EXTERNAL: str = "external"
+  INCOMPATIBLE: str = "incompatible"
+
+  def __init__(self, kind: str, label: str, location: str,
+      attributes: Dict[str, Any], rejected: str = "",
+      raw_block: str = "") -> None:
+    self.kind: str = kind
+    self.label: str = label
+    self.location: str = location
+    # Explicitly specified attributes only, values are decoded to python types:
+    # str, int, bool, List[str] or Dict[str, str]
+    self.attributes: Dict[str, Any] = attributes
+    # Set if a decoder rejected the target before decoding its attributes, the
+    # attributes hold its name and outputs at most then (external targets have
+    # none).
+    self.rejected: str = rejected
+    # Build output block of the target, if decoding of its value attributes
+    # was deferred (the attributes hold label attributes only then)
+    self.raw_block: str = raw_block
+
+
+def read_delimited_messages(stream: IO[bytes]) -> Iterator[bytes]:
+  while True:
+    size: int = 0
+    shift: int = 0
+    while True:
+      byte: bytes = stream.read(1)
+      if not byte:
+        if shift:
+          raise ValueError("Truncated message size in delimited stream")
+        return
+      size |= (byte[0] & 0x7F) << shift
+      shift += 7
+      if byte[0] < 0x80:
+        break
+    message: bytes = stream.read(size)
+    if len(message) != size:
+      raise ValueError("Truncated message in delimited stream")
+    yield message
+
+
+def decode_streamed_proto_message(message: bytes) -> Optional[QueryRule]:
+  fields: List[Tuple[int, int, Any]] = list(_iter_fields(message))
+  if not fields:
+    return None
+  # cquery streams analysis.ConfiguredTarget messages with a Target in field
+  # 1, query streams blaze_query.Target messages with a type enum in field 1.
+  field_number, wire_type, value = fields[0]
+  if field_number == 1 and wire_type == _LENGTH_DELIMITED:
+    return _decode_target(value)
+  return _decode_target_fields(fields)
+
+
+def decode_jsonproto_output(output: str) -> Iterator[QueryRule]:
+  result: Dict[str, Any] = json.loads(output) if output.strip() else {}
+  # cquery prints CqueryResult, query prints QueryResult
+  targets: Iterable[Dict[str, Any]] = (r.get("target", {}) for r in
+                                       result.get("results", []))
+  if "target" in result:
+    targets = result["target"]
+  for target in targets:
+    if target.get("type") != "RULE":
+      continue
+    rule: Dict[str, Any] = target["rule"]
+    attributes: Dict[str, Any] = {}
+    for attr in rule.get("attribute", []):
+      if not attr.get("explicitlySpecified"):
+        continue
+      attributes[attr["name"]] = _json_attribute_value(attr)
+    yield QueryRule(rule["ruleClass"], rule["name"], rule.get("location", ""),
+                    attributes)
+
+
+def _json_attribute_value(attr: Dict[str, Any]) -> Any:
+  if "stringListValue" in attr:
+    return list(attr["stringListValue"])
+  if "stringDictValue" in attr:
+    return {e["key"]: e.get("value", "") for e in attr["stringDictValue"]}
+  if "booleanValue" in attr:
+    return bool(attr["booleanValue"])
+  if "intValue" in attr:
+    return int(attr["intValue"])
+  if "stringValue" in attr:
+    return attr["stringValue"]
+  attr_type: str = attr.get("type", "")
+  if attr_type.endswith("_LIST"):
+    return []
+  if attr_type == "STRING_DICT":
+    return {}
+  return ""
+
+
+def _decode_target(message: bytes) -> Optional[QueryRule]:
+  return _decode_target_fields(_iter_fields(message))
+
+
+def _decode_target_fields(fields: Iterable[Tuple[int, int, Any]]) -> Optional[
+  QueryRule]:
+  target_type: int = 0
+  rule: Optional[bytes] = None
+  for field_number, _, value in fields:
+    if field_number == 1:
+      target_type = value
+    elif field_number == 2:
+      rule = value
+  if target_type != _TARGET_TYPE_RULE or rule is None:
+    return None
+  return _decode_rule(rule)
+
+
+def _decode_rule(message: bytes) -> QueryRule:
+  label: str = ""
+  kind: str = ""
+  location: str = ""
+  attributes: Dict[str, Any] = {}
+  for field_number, _, value in _iter_fields(message):
+    if field_number == 1:
+      label = value.decode("utf-8")
+    elif field_number == 2:
+      kind = value.decode("utf-8")
+    elif field_number == 3:
+      location = value.decode("utf-8")
+    elif field_number == 4:
+      attr: Optional[Tuple[str, Any]] = _decode_attribute(value)
+      if attr:
+        attributes[attr[0]] = attr[1]
+  return QueryRule(kind, label, location, attributes)
+
+
+def _decode_attribute(message: bytes) -> Optional[Tuple[str, Any]]:
+  name: str = ""
+  explicitly_specified: bool = False
+  string_value: Optional[str] = None
+  int_value: Optional[int] = None
+  bool_value: Optional[bool] = None
+  string_list_value: Optional[List[str]] = None
+  string_dict_value: Optional[Dict[str, str]] = None
+
+  for field_number, _, value in _iter_fields(message):
+    if field_number == 1:
+      name = value.decode("utf-8")
+    elif field_number == 3:
+      # int32, negative values are sign extended to 64 bits
+      int_value = value - (1 << 64) if value >= (1 << 63) else value
+    elif field_number == 5:
+      string_value = value.decode("utf-8")
+    elif field_number == 6:
+      if string_list_value is None:
+        string_list_value = []
+      string_list_value.append(value.decode("utf-8"))
+    elif field_number == 8:
+      if string_dict_value is None:
+        string_dict_value = {}
+      entry: Dict[int, str] = {n: v.decode("utf-8") for n, _, v in
+                               _iter_fields(value)}
+      string_dict_value[entry.get(1, "")] = entry.get(2, "")
+    elif field_number == 13:
+      explicitly_specified = bool(value)
+    elif field_number == 14:
+      bool_value = bool(value)
+
+  if not explicitly_specified:
+    return None
+  if string_list_value is not None:
+    return name, string_list_value
+  if string_dict_value is not None:
+    return name, string_dict_value
+  if bool_value is not None:
+    return name, bool_value
+  if int_value is not None:
+    return name, int_value
+  if string_value is not None:
+    return name, string_value
+  # Empty repeated fields are not serialized at all
+  return name, []
+
+
+def _iter_fields(message: bytes) -> Iterator[Tuple[int, int, Any]]:
+  pos: int = 0
+  end: int = len(message)
+  while pos < end:
+    key, pos = _read_varint(message, pos)
+    field_number: int = key >> 3
+    wire_type: int = key & 0x7
+    value: Any
+    if wire_type == _VARINT:
+      value, pos = _read_varint(message, pos)
+    elif wire_type == _LENGTH_DELIMITED:
+      size: int
+      size, pos = _read_varint(message, pos)
+      value = message[pos:pos + size]
+      pos += size
+    elif wire_type == _FIXED64:
+      value = message[pos:pos + 8]
+      pos += 8
+    elif wire_type == _FIXED32:
+      value = message[pos:pos + 4]
+      pos += 4
+    else:
+      raise ValueError(f"Unsupported protobuf wire type: {wire_type}")
+    yield field_number, wire_type, value
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+  result: int = 0
+  shift: int = 0
+  while True:
+    byte: int = data[pos]
+    pos += 1
+    result |= (byte & 0x7F) << shift
+    shift += 7
+    if byte < 0x80:
+      return result, pos
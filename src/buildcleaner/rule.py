@@ -4,6 +4,11 @@ from typing import Sequence
 
 
 class Rule:
+  __slots__ = ("kind", "label_list_args", "label_args", "string_list_args",
+               "string_args", "bool_args", "int_args", "str_str_map_args",
+               "out_label_list_args", "out_label_args", "import_statement",
+               "outputs", "macro", "visibility")
+
   def __init__(self, kind: str,
       label_list_args: Sequence[str] = (),
       label_args: Sequence[str] = (),
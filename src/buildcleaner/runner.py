@@ -1,68 +1,304 @@
+import gzip
+import io
+import mmap
+import os
+import re
 import subprocess
-from typing import Iterable
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict
+from typing import IO
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Pattern
 from typing import Sequence
-from typing import Set
+from typing import cast
+
+from buildcleaner.cache import QueryCache
+from buildcleaner.cache import QueryCacheEntryWriter
+from buildcleaner.cache import WorkspaceFingerprint
+from buildcleaner.proto import read_delimited_messages
 
 
 class BazelRunner:
+  # --keep_going makes bazel exit with 3 if some of the targets failed, the
+  # output is still complete for the rest of the targets.
+  _CACHEABLE_RETURN_CODES: Sequence[int] = (0, 3)
+  # Longer query expressions are passed through --query_file. A single command
+  # line argument is limited to 128KB on Linux, and bazel is slow to parse huge
+  # argv anyway.
+  _QUERY_FILE_THRESHOLD: int = 64 * 1024
+
+  def __init__(self, query_cache: Optional[QueryCache] = None,
+      workspace_path: str = "", replay: bool = False) -> None:
+    if replay and not query_cache:
+      raise ValueError("Replay mode requires query cache")
+    self._query_cache: Optional[QueryCache] = query_cache
+    self._workspace_path: str = workspace_path
+    self._replay: bool = replay
+    self._workspace_fingerprint: str = ""
+    self._workspace_fingerprint_lock: threading.Lock = threading.Lock()
+
   def query_deps_output(self, targets: List[str], config: str = "pycpp_filters",
-      output: str = "label_kind", excluded_targets: Sequence[str] = ()) -> str:
+      output: str = "label_kind", excluded_targets: Sequence[str] = (),
+      output_base: str = "", command: str = "cquery", depth: int = -1) -> str:
+    with self._open_deps_output(targets, config, output, excluded_targets,
+                                output_base, command, depth) as query_stdout:
+      return query_stdout.read().decode('utf-8')
+
+  # Yields targets (blocks of lines separated by empty lines) of the query
+  # output as soon as bazel prints them, so the whole output is never held in
+  # memory at once.
+  def stream_deps_output(self, targets: List[str],
+      config: str = "pycpp_filters", output: str = "build",
+      excluded_targets: Sequence[str] = (), output_base: str = "",
+      command: str = "cquery", depth: int = -1) -> Iterator[str]:
+    with self._open_deps_output(targets, config, output, excluded_targets,
+                                output_base, command, depth) as query_stdout:
+      text_stdout: io.TextIOWrapper = io.TextIOWrapper(query_stdout,
+                                                       encoding="utf-8")
+      block_lines: List[str] = []
+      for line in text_stdout:
+        line = line.rstrip("\r\n")
+        if line:
+          block_lines.append(line)
+        elif block_lines:
+          yield "\n".join(block_lines)
+          block_lines = []
+      if block_lines:
+        yield "\n".join(block_lines)
+      # The wrapper would close query_stdout once garbage collected
+      text_stdout.detach()
 
-    chunk: str = "'" + "' union '".join(targets) + "'"
-    query: List[str] = [
-        "bazel",
-        "cquery",
+  # Yields lines of the query output (e.g. of label_kind output) as soon as
+  # bazel prints them.
+  def stream_deps_lines(self, targets: List[str],
+      config: str = "pycpp_filters", output: str = "label_kind",
+      excluded_targets: Sequence[str] = (), output_base: str = "",
+      command: str = "cquery", depth: int = -1) -> Iterator[str]:
+    with self._open_deps_output(targets, config, output, excluded_targets,
+                                output_base, command, depth) as query_stdout:
+      text_stdout: io.TextIOWrapper = io.TextIOWrapper(query_stdout,
+                                                       encoding="utf-8")
+      for line in text_stdout:
+        line = line.rstrip("\r\n")
+        if line:
+          yield line
+      # The wrapper would close query_stdout once garbage collected
+      text_stdout.detach()
+
+  # Yields length-delimited protobuf messages of streamed_proto output as soon
+  # as bazel prints them.
+  def stream_deps_messages(self, targets: List[str],
+      config: str = "pycpp_filters", output: str = "streamed_proto",
+      excluded_targets: Sequence[str] = (), output_base: str = "",
+      command: str = "cquery", depth: int = -1) -> Iterator[bytes]:
+    with self._open_deps_output(targets, config, output, excluded_targets,
+                                output_base, command, depth) as query_stdout:
+      yield from read_delimited_messages(query_stdout)
+
+  def _deps_query(self, targets: List[str], config: str, output: str,
+      excluded_targets: Sequence[str], output_base: str, command: str,
+      depth: int, query_file: str = "") -> List[str]:
+    query: List[str] = ["bazel"]
+    if output_base:
+      # A separate output base means a separate bazel server, so queries with
+      # different output bases do not block each other on the server lock.
+      query.append(f"--output_base={output_base}")
+    query.extend([
+        command,
         f"--config={config}" if config else "",
         # f"'//tensorflow'",
-        f"deps({chunk})",
+        f"--query_file={query_file}" if query_file else
+        self._deps_expression(targets, depth),
         "--keep_going",
         "--output",
         f"{output}"
-    ]
+    ])
+    if excluded_targets and not query_file:
+      query.append(self._except_expression(excluded_targets))
+    return query
+
+  # Same as _deps_query(), but the query expression is moved to a temporary
+  # query file if it is too long for the command line.
+  @contextmanager
+  def _deps_command(self, targets: List[str], config: str, output: str,
+      excluded_targets: Sequence[str], output_base: str, command: str,
+      depth: int) -> Iterator[List[str]]:
+    expression: str = self._deps_expression(targets, depth)
     if excluded_targets:
-      query.append("--")
-      query.extend([f"-{t}" for t in excluded_targets])
-
-    proc = subprocess.run(query, stdout=subprocess.PIPE)
-
-    return proc.stdout.decode('utf-8')
-
-  # def query_output(self, targets: Set[str], config: str = "pycpp_filters",
-  #     output: str = "build", excluded_targets: Sequence[str] = (),
-  #     chunk_size: int = 1500) -> str:
-  #   bazel_query_stdouts: List[str] = []
-  #   for target_chunk in self._split_into_chunks(targets, chunk_size):
-  #     chunk: str = "'" + "' union '".join(target_chunk) + "'"
-  #     query: List[str] = [
-  #         "bazel",
-  #         "cquery",
-  #         f"--config={config}" if config else "",
-  #         chunk,
-  #         "--output",
-  #         "--keep_going",
-  #         f"{output}"
-  #     ]
-  #     if excluded_targets:
-  #       query.append("--")
-  #       query.extend([f"-{t}" for t in excluded_targets])
-  #
-  #     proc = subprocess.run(query, stdout=subprocess.PIPE)
-  #
-  #     bazel_query_stdouts.append(proc.stdout.decode('utf-8'))
-  #   return "\n".join(bazel_query_stdouts)
-
-  def _split_into_chunks(self, targets: Set[str], chunk_size) -> Iterable[
-    Iterable[str]]:
-    if len(targets) <= chunk_size:
-      yield targets
+      expression += f" {self._except_expression(excluded_targets)}"
+    if len(expression) <= BazelRunner._QUERY_FILE_THRESHOLD:
+      yield self._deps_query(targets, config, output, excluded_targets,
+                             output_base, command, depth)
       return
-    cur_chunk: List[str] = []
-    for target in targets:
-      if len(cur_chunk) >= chunk_size:
-        yield cur_chunk
-        cur_chunk = []
-      cur_chunk.append(target)
-
-    if cur_chunk:
-      yield cur_chunk
+
+    fd, query_file = tempfile.mkstemp(prefix="buildcleaner_", suffix=".query")
+    try:
+      with os.fdopen(fd, "w") as f:
+        f.write(expression)
+      yield self._deps_query(targets, config, output, excluded_targets,
+                             output_base, command, depth, query_file)
+    finally:
+      os.remove(query_file)
+
+  # Negative depth means the whole transitive closure
+  def _deps_expression(self, targets: List[str], depth: int) -> str:
+    union: str = "'" + "' union '".join(targets) + "'"
+    return f"deps({union}, {depth})" if depth >= 0 else f"deps({union})"
+
+  # Labels are quoted, as target names may have characters which are not
+  # allowed in query words (e.g. "+" or "="), and are subtracted all at once.
+  def _except_expression(self, excluded_targets: Sequence[str]) -> str:
+    quoted_targets: List[str] = [f'"{t}"' if "'" in t else f"'{t}'" for t in
+                                 excluded_targets]
+    return f"except set({' '.join(quoted_targets)})"
+
+  @contextmanager
+  def _open_deps_output(self, targets: List[str], config: str, output: str,
+      excluded_targets: Sequence[str], output_base: str, command: str,
+      depth: int) -> Iterator[IO[bytes]]:
+    if not self._query_cache:
+      with self._deps_command(targets, config, output, excluded_targets,
+                              output_base, command, depth) as command_line, \
+          subprocess.Popen(command_line, stdout=subprocess.PIPE) as proc:
+        yield cast(IO[bytes], proc.stdout)
+      return
+
+    # Everything except output base, which does not affect the output. The
+    # expression is always keyed in its command line form, whether it is
+    # passed through a query file or not.
+    query: List[str] = self._deps_query(targets, config, output,
+                                        excluded_targets, output_base, command,
+                                        depth)
+    cache_key: str = self._query_cache.key(
+        [*query[query.index(command):], self._get_workspace_fingerprint()])
+    cached_output: Optional[gzip.GzipFile] = self._query_cache.open_reader(
+        cache_key)
+    if cached_output is not None:
+      with cached_output:
+        yield cast(IO[bytes], cached_output)
+      return
+
+    if self._replay:
+      raise LookupError(f"Query output is not cached: query = {query}")
+
+    entry_writer: QueryCacheEntryWriter = self._query_cache.open_writer(
+        cache_key)
+    committed: bool = False
+    try:
+      with self._deps_command(targets, config, output, excluded_targets,
+                              output_base, command, depth) as command_line, \
+          subprocess.Popen(command_line, stdout=subprocess.PIPE) as proc:
+        tee_stdout: IO[bytes] = io.BufferedReader(
+            _TeeReader(cast(io.BufferedReader, proc.stdout), entry_writer))
+        try:
+          yield tee_stdout
+          # Only complete output can be cached
+          while tee_stdout.read(io.DEFAULT_BUFFER_SIZE):
+            pass
+        except BaseException:
+          proc.kill()
+          raise
+      if proc.returncode in BazelRunner._CACHEABLE_RETURN_CODES:
+        entry_writer.commit()
+        committed = True
+    finally:
+      if not committed:
+        entry_writer.discard()
+
+  def _get_workspace_fingerprint(self) -> str:
+    with self._workspace_fingerprint_lock:
+      if not self._workspace_fingerprint:
+        self._workspace_fingerprint = self._compute_workspace_fingerprint()
+    return self._workspace_fingerprint
+
+  def _compute_workspace_fingerprint(self) -> str:
+    query_cache: QueryCache = cast(QueryCache, self._query_cache)
+    # Output base identifies the state of external repositories, it is
+    # remembered in the cache itself, so replay never has to ask bazel for it.
+    output_base_key: str = f"output_base:{self._workspace_path}"
+    output_base: Optional[str] = query_cache.get_value(output_base_key)
+    if not self._replay:
+      proc = subprocess.run(["bazel", "info", "output_base"],
+                            stdout=subprocess.PIPE)
+      output_base = proc.stdout.decode('utf-8').strip()
+      query_cache.put_value(output_base_key, output_base)
+    elif output_base is None:
+      raise LookupError(
+          f"Workspace is not cached: workspace = {self._workspace_path}")
+
+    build_files_hash: str = WorkspaceFingerprint(self._workspace_path).compute()
+    return query_cache.key([build_files_hash, output_base])
+
+
+# Serves saved query outputs (e.g. dumps from CI) instead of running bazel. A
+# dump is the output of every query of its output format, whatever the
+# targets, so it must contain the whole deps() closure. The parser skips the
+# targets it already knows on subsequent rounds. Dumps are memory-mapped and
+# parsed from the mapping, they are never read into memory as a whole.
+class DumpRunner(BazelRunner):
+  def __init__(self, dump_paths: Dict[str, str]) -> None:
+    super().__init__()
+    # Path to the dump of each output format ("build", "label_kind", etc.)
+    self._dump_paths: Dict[str, str] = dict(dump_paths)
+    self._block_separator_regex: Pattern = re.compile(rb"(?:\r?\n){2,}")
+
+  def stream_deps_output(self, targets: List[str],
+      config: str = "pycpp_filters", output: str = "build",
+      excluded_targets: Sequence[str] = (), output_base: str = "",
+      command: str = "cquery", depth: int = -1) -> Iterator[str]:
+    with self._map_dump(output) as dump:
+      start: int = 0
+      for separator in self._block_separator_regex.finditer(dump):
+        if separator.start() > start:
+          yield dump[start:separator.start()].decode("utf-8")
+        start = separator.end()
+      if start < len(dump):
+        yield dump[start:].decode("utf-8").rstrip("\r\n")
+
+  def stream_deps_lines(self, targets: List[str],
+      config: str = "pycpp_filters", output: str = "label_kind",
+      excluded_targets: Sequence[str] = (), output_base: str = "",
+      command: str = "cquery", depth: int = -1) -> Iterator[str]:
+    with self._map_dump(output) as dump:
+      for line in iter(dump.readline, b""):
+        line = line.rstrip(b"\r\n")
+        if line:
+          yield line.decode("utf-8")
+
+  @contextmanager
+  def _open_deps_output(self, targets: List[str], config: str, output: str,
+      excluded_targets: Sequence[str], output_base: str, command: str,
+      depth: int) -> Iterator[IO[bytes]]:
+    with self._map_dump(output) as dump:
+      yield cast(IO[bytes], dump)
+
+  @contextmanager
+  def _map_dump(self, output: str) -> Iterator[mmap.mmap]:
+    dump_path: Optional[str] = self._dump_paths.get(output)
+    if not dump_path:
+      raise LookupError(f"No dump of query output: output = {output}")
+    with open(dump_path, "rb") as dump_file, mmap.mmap(
+        dump_file.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+      yield dump
+
+
+# Copies everything read from the source stream into a cache entry
+class _TeeReader(io.RawIOBase):
+  # Popen pipes are buffered, so read1() returns as soon as anything is read
+  def __init__(self, source: io.BufferedReader,
+      sink: QueryCacheEntryWriter) -> None:
+    self._source: io.BufferedReader = source
+    self._sink: QueryCacheEntryWriter = sink
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, buffer) -> int:
+    data: bytes = self._source.read1(len(buffer))
+    self._sink.write(data)
+    buffer[:len(data)] = data
+    return len(data)
@@ -1,10 +1,19 @@
+from itertools import chain
+from typing import Dict
+from typing import Optional
+
 from buildcleaner.build import Build
+from buildcleaner.cache import PackageParseCache
+from buildcleaner.cache import QueryCache
 from buildcleaner.config import ArtifactTargetsConfig
 from buildcleaner.config import BaseTargetsConfig
 from buildcleaner.config import MergedTargetsConfig
 from buildcleaner.graph import TargetDag
+from buildcleaner.node import LabelRegistry
 from buildcleaner.parser import BazelBuildTargetsParser
 from buildcleaner.rule import BuiltInRules
+from buildcleaner.rule import Rule
+from buildcleaner.runner import BazelRunner
 from buildcleaner.tensorflow.rule import TfRules
 from buildcleaner.tensorflow.transformer import ChainedCcLibraryMerger
 from buildcleaner.tensorflow.transformer import TfNonsenseTransformer
@@ -18,12 +27,23 @@ from buildcleaner.transformer import UnreachableTargetsRemover
 class TfBuild(Build):
   def __init__(self, base_targets: BaseTargetsConfig,
       prefix_path: str, merged_targets: MergedTargetsConfig,
-      artifact_targets: ArtifactTargetsConfig) -> None:
+      artifact_targets: ArtifactTargetsConfig,
+      bazel_runner: BazelRunner,
+      package_cache: Optional[QueryCache] = None) -> None:
+    rules_to_parse: Dict[str, Rule] = BuiltInRules.rules(TfRules.rules())
+    rules_to_ignore: Dict[str, Rule] = TfRules.ignored_rules()
+    package_parse_cache: Optional[PackageParseCache] = None
+    if package_cache:
+      package_parse_cache = PackageParseCache(
+          package_cache, prefix_path,
+          chain(rules_to_parse.values(), rules_to_ignore.values()),
+          [base_targets.bazel_config, base_targets.query_command])
     super().__init__(base_targets,
-                     BazelBuildTargetsParser(prefix_path,
-                                             BuiltInRules.rules(
-                                                 TfRules.rules()),
-                                             TfRules.ignored_rules()))
+                     BazelBuildTargetsParser(prefix_path, rules_to_parse,
+                                             rules_to_ignore, LabelRegistry(),
+                                             base_targets.lazy_attrs,
+                                             package_parse_cache),
+                     bazel_runner)
 
     AliasReplacer().transform(self.repo_root())
     TrivialPrivateRuleToPublicMacroTransformer().transform(self.repo_root())
@@ -1,7 +1,9 @@
 import sys
 from typing import List
+from typing import Optional
 
 from buildcleaner.build import Build
+from buildcleaner.cache import QueryCache
 from buildcleaner.cli import BuildCleanerCli
 from buildcleaner.tensorflow.build import TfBuild
 
@@ -11,8 +13,11 @@ class TfBuildCleanerCli(BuildCleanerCli):
     super().__init__(cli_args)
 
   def generate_build(self) -> Build:
+    package_cache: Optional[QueryCache] = self.create_query_cache() \
+      if self._config.query_cache.packages else None
     return TfBuild(self._config.base_targets, self._config.prefix_path,
-                   self._config.merged_targets, self._config.artifact_targets)
+                   self._config.merged_targets, self._config.artifact_targets,
+                   self.create_bazel_runner(), package_cache)
 
 
 if __name__ == '__main__':
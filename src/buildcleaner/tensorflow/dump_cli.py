@@ -0,0 +1,47 @@
+import sys
+from typing import Dict
+from typing import List
+
+from buildcleaner.config import BaseTargetsConfig
+from buildcleaner.runner import BazelRunner
+from buildcleaner.runner import DumpRunner
+from buildcleaner.tensorflow.cli import TfBuildCleanerCli
+
+
+# Runs the simplifier on saved query outputs instead of a live workspace:
+#   --build_dump=<path> output of bazel cquery --output=build
+#   --label_kind_dump=<path> output of bazel cquery --output=label_kind,
+#       source files are inferred from build dump if omitted
+class TfDumpBuildCleanerCli(TfBuildCleanerCli):
+  def __init__(self, cli_args: List[str]) -> None:
+    self._dump_paths: Dict[str, str] = {}
+    config_args: List[str] = []
+    for cli_arg in cli_args:
+      arg_name, _, arg_val = cli_arg.partition("=")
+      if arg_name == "--build_dump":
+        self._dump_paths["build"] = arg_val
+      elif arg_name == "--label_kind_dump":
+        self._dump_paths["label_kind"] = arg_val
+      else:
+        config_args.append(cli_arg)
+    super().__init__(config_args)
+    if "build" not in self._dump_paths:
+      raise ValueError("Build dump path is not set, use --build_dump=<path>")
+
+    # Every query is answered with the whole dump, so there is nothing to
+    # split into chunks or to run concurrently.
+    base_targets: BaseTargetsConfig = self._config.base_targets
+    base_targets.query_output = "build"
+    base_targets.query_command = "cquery"
+    base_targets.jobs = 1
+    base_targets.secondary_output_base = ""
+    if "label_kind" not in self._dump_paths:
+      base_targets.infer_label_kinds = True
+
+  def create_bazel_runner(self) -> BazelRunner:
+    return DumpRunner(self._dump_paths)
+
+
+if __name__ == '__main__':
+  cli = TfDumpBuildCleanerCli(sys.argv[1:])
+  cli.main()
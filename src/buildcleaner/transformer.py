@@ -58,16 +58,16 @@ class ExportFilesTransformer(RuleTransformer):
 
   def _collect_files_referenced_from_other_pkgs(self, cont_node: ContainerNode,
       file_to_packages: Dict[str, Set[PackageNode]]) -> None:
-    for child in cont_node.children.values():
-      if isinstance(child, ContainerNode):
-        self._collect_files_referenced_from_other_pkgs(child, file_to_packages)
-      elif type(child) == TargetNode and isinstance(cont_node, PackageNode):
-        target_child = cast(TargetNode, child)
-        for file_dep in target_child.get_targets(FileNode.SOURCE_FILE_KIND):
-          file_dep_parent_label: str = file_dep.get_parent_label()
-          if file_dep_parent_label != str(cont_node):
-            file_to_packages.setdefault(str(file_dep), set()).add(
-                cast(PackageNode, cont_node))
+    for child in cont_node.get_containers():
+      self._collect_files_referenced_from_other_pkgs(child, file_to_packages)
+    if not isinstance(cont_node, PackageNode):
+      return
+    for target_child in cont_node.get_targets_of_class(TargetNode):
+      for file_dep in target_child.get_targets(FileNode.SOURCE_FILE_KIND):
+        file_dep_parent_label: str = file_dep.get_parent_label()
+        if file_dep_parent_label != str(cont_node):
+          file_to_packages.setdefault(str(file_dep), set()).add(
+              cast(PackageNode, cont_node))
 
 
 class UnreachableTargetsRemover(RuleTransformer):
@@ -0,0 +1,110 @@
+import unittest
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import cast
+
+from buildcleaner.node import ContainerNode
+from buildcleaner.node import FileNode
+from buildcleaner.node import Node
+from buildcleaner.node import PackageNode
+from buildcleaner.node import RepositoryNode
+from buildcleaner.node import RootNode
+from buildcleaner.node import TargetNode
+from buildcleaner.rule import BuiltInRules
+from buildcleaner.rule import Rule
+
+
+class ContainerNodeIndexTest(unittest.TestCase):
+  def setUp(self) -> None:
+    self.cc_library: Rule = BuiltInRules.rules()["cc_library"]
+    self.cc_binary: Rule = BuiltInRules.rules()["cc_binary"]
+    self.root: RootNode = RootNode("")
+    self.root.add_child(RepositoryNode("", ""))
+    self.root["//a"] = PackageNode("a", "//", 2)
+    self.root["//a/b"] = PackageNode("b", "//a", 3)
+    self.root["//a:t"] = TargetNode(self.cc_library, "t", "//a")
+    self.root["//a:f.cc"] = FileNode("f.cc", "//a")
+    self.root["//a/b:u"] = TargetNode(self.cc_library, "u", "//a/b")
+    self.root["//a/b:g.cc"] = FileNode("g.cc", "//a/b")
+
+  def test_add_child(self) -> None:
+    package: PackageNode = PackageNode("c", "//a", 3)
+    package.add_child(TargetNode(self.cc_binary, "v", "//a/c"))
+    package.add_child(FileNode("h.cc", "//a/c"))
+    cast(ContainerNode, self.root["//a"]).add_child(package)
+    self.assertIs(self.root["//a/c:v"], package.children["//a/c:v"])
+    self._check_indexes(self.root)
+
+  def test_remove_child(self) -> None:
+    package: ContainerNode = cast(ContainerNode, self.root["//a"])
+    package.remove_child("//a:f.cc")
+    package.remove_child("//a/b")
+    self.assertIsNone(self.root["//a:f.cc"])
+    self.assertIsNone(self.root["//a/b:u"])
+    self._check_indexes(self.root)
+
+  def test_replace_child(self) -> None:
+    previous_target: Node = cast(Node, self.root["//a:t"])
+    target: TargetNode = TargetNode(self.cc_binary, "t", "//a")
+    self.root["//a:t"] = target
+    self.assertIs(self.root["//a:t"], target)
+    self.assertFalse(any(
+        t is previous_target for t in
+        cast(ContainerNode, self.root["//a"]).get_targets()))
+    self._check_indexes(self.root)
+
+  def test_del_item(self) -> None:
+    subtree: ContainerNode = cast(ContainerNode, self.root["//a/b"])
+    del self.root["//a/b"]
+    del self.root["//a:t"]
+    self.assertIsNone(self.root["//a/b"])
+    self.assertIsNone(self.root["//a:t"])
+    self._check_indexes(self.root)
+    # The removed subtree keeps an index of its own
+    self.assertIs(subtree["//a/b:u"], subtree.children["//a/b:u"])
+    self._check_indexes(subtree)
+
+  def test_check_label_index_detects_stale_index(self) -> None:
+    package: ContainerNode = cast(ContainerNode, self.root["//a"])
+    del package.children["//a:t"]
+    with self.assertRaises(LookupError):
+      self.root.check_label_index()
+
+  # Compares the indexes to a full walk of the tree, both through
+  # check_label_index() and directly
+  def _check_indexes(self, root: ContainerNode) -> None:
+    root.check_label_index()
+    tree_nodes: List[Node] = list(root.tree_nodes())
+    self.assertEqual({n.label: n for n in tree_nodes},
+                     {label: node for label, node in root._label_index.items()
+                      if root._is_ancestor_of(label)})
+    for container in tree_nodes:
+      if not isinstance(container, ContainerNode):
+        continue
+      children: List[Node] = list(container.children.values())
+      targets: List[TargetNode] = [cast(TargetNode, n) for n in children if
+                                   isinstance(n, TargetNode)]
+      containers: List[ContainerNode] = [cast(ContainerNode, n) for n in
+                                         children if
+                                         isinstance(n, ContainerNode)]
+      self.assertEqual(list(container.get_targets()), targets)
+      self.assertEqual(list(container.get_containers()), containers)
+      kinds: Set[Rule] = {n.kind for n in children}
+      for kind in kinds:
+        self.assertEqual(list(container.get_targets(kind)),
+                         [t for t in targets if t.kind == kind])
+        self.assertEqual(list(container.get_containers(kind)),
+                         [c for c in containers if c.kind == kind])
+      classes: Dict[type, List[TargetNode]] = {}
+      for target in targets:
+        classes.setdefault(type(target), []).append(target)
+      for node_class, class_targets in classes.items():
+        self.assertEqual(list(container.get_targets_of_class(node_class)),
+                         class_targets)
+      for target in targets:
+        self.assertIs(container.get_target(target.name), target)
+
+
+if __name__ == '__main__':
+  unittest.main()